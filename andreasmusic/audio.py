@@ -1,54 +1,145 @@
 import os
 import collections
 import subprocess
+import struct
+import tempfile
+import fractions
 import scipy.io.wavfile
+import scipy.signal
 import numpy as np
+from contextlib import contextmanager
 
 from andreasmusic import util
 
+FFMPEG = 'ffmpeg'
+
+# bytes read from the decoder pipe at a time
+PIPE_BUFFER_SIZE = 2**16
+
 class Audio(object):
     def __init__(self, signal, sample_rate):
         self.signal = signal
         self.sample_rate = sample_rate
 
-    def write(self, filename):
+    def write(self, filename, sample_format='float32', dither=False):
+        # sample_format and dither only apply to wav files, see WavWriter
         filename = os.path.expanduser(filename)
         _, extension = os.path.splitext(filename)
         if extension in ['.mp3']:
             return self._write_mp3(filename)
         elif extension == '.wav':
-            return self._write_wav(filename)
+            return self._write_wav(filename, sample_format, dither)
         else:
             raise NotImplementedError('Unknown file extension: %s (%s)' %
                                       (extension, filename))
 
     def _write_mp3(self, filename):
-        with util.temporary_filename('.wav') as wav_filename:
-            self._write_wav(wav_filename)
-            subprocess.check_output(['ffmpeg', '-y', '-i', wav_filename, filename], stderr=subprocess.STDOUT)
+        n_channels = self.signal.shape[1]
+        command = [FFMPEG, '-y', '-f', 'f32le', '-ar', str(self.sample_rate),
+                   '-ac', str(n_channels), '-i', 'pipe:0', filename]
+        block_samples = max(PIPE_BUFFER_SIZE // (4 * n_channels), 1)
+
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                       stdout=stderr, stderr=stderr)
+            try:
+                for t in xrange(0, len(self.signal), block_samples):
+                    block = np.asarray(self.signal[t:t + block_samples], dtype='<f4')
+                    process.stdin.write(block.tobytes())
+            except IOError:
+                pass
+            process.stdin.close()
+            _check_process(process, command, stderr)
 
-    def _write_wav(self, filename):
-        scipy.io.wavfile.write(filename, self.sample_rate, self.signal)
+    def _write_wav(self, filename, sample_format='float32', dither=False):
+        blocks = (self.signal[t:t + WAV_BLOCK_SAMPLES]
+                  for t in xrange(0, len(self.signal), WAV_BLOCK_SAMPLES))
+        write_wav_blocks(filename, blocks, self.sample_rate, sample_format, dither,
+                         channels=self.signal.shape[1])
 
     def downsample(self, factor):
+        # naive decimation, fast but aliases. use resample for quality
         signal = self.signal[::factor, :]
         sample_rate = self.sample_rate // factor
         return Audio(signal, sample_rate)
 
+    def resample(self, sample_rate):
+        # polyphase fir resampling by the rational factor up / down,
+        # computed in blocks of output samples whose gathered float32
+        # input windows hold at most RESAMPLE_BLOCK_VALUES values
+        sample_rate = int(sample_rate)
+        divisor = fractions.gcd(int(self.sample_rate), sample_rate)
+        up = sample_rate // divisor
+        down = int(self.sample_rate) // divisor
+        if up == down:
+            return Audio(self.signal[:], sample_rate)
+
+        phases, half_len = get_resample_filter(up, down)
+        phases = phases.astype('float32')
+        n_taps = phases.shape[1]
+        n_in, n_channels = self.signal.shape
+        n_out = -(-n_in * up // down)
+        signal = np.zeros((n_out, n_channels), dtype='float32')
+        block_samples = max(RESAMPLE_BLOCK_VALUES // (n_taps * n_channels), 1)
+
+        for n0 in xrange(0, n_out, block_samples):
+            n = np.arange(n0, min(n0 + block_samples, n_out))
+            # position of each output sample in the upsampled signal,
+            # split into filter phase and the newest input sample used
+            position = n * down + half_len
+            phase = position % up
+            newest = position // up
+
+            start = newest[0] - n_taps + 1
+            end = newest[-1] + 1
+            x = np.zeros((end - start, n_channels), dtype='float32')
+            x[max(-start, 0):min(n_in, end) - start] = self.signal[max(start, 0):min(n_in, end)]
+
+            indices = newest[:, np.newaxis] - np.arange(n_taps) - start
+            signal[n0:n0 + len(n)] = np.einsum('nt,ntc->nc', phases[phase], x[indices])
+
+        return Audio(signal, sample_rate)
+
     def get_channel(self, channel_x):
+        if isinstance(self.signal, LazySignal):
+            return Audio(self.signal.get_channel(channel_x), self.sample_rate)
         signal = self.signal[:, channel_x][:, np.newaxis]
         return Audio(signal, self.sample_rate)
 
-    def find_zero_crossing(self, t, max_t=1000):
-        for i in xrange(max_t):
-            cur = self.signal[t + i]
-            prev = self.signal[t + i - 1]
-            if np.sign(cur) != np.sign(prev):
-                if np.abs(prev) < np.abs(cur):
-                    return t + i - 1
-                else:
-                    return t + i
-        return t
+    def find_zero_crossing(self, t, max_t=1000, channel=None):
+        return int(self.find_zero_crossings([t], max_t, channel)[0])
+
+    def find_zero_crossings(self, ts, max_t=1000, channel=None):
+        # snaps each t to the first sign change within max_t samples,
+        # picking whichever of the two samples around it is closer to
+        # zero, or leaves it where it is if there is none. multi-channel
+        # signals are searched on their mean unless a channel is given
+        ts = np.asarray(ts, dtype=int)
+        if len(ts) == 0:
+            return ts
+
+        # column j of each row is sample t + j - 1
+        positions = ts[:, np.newaxis] + np.arange(-1, max_t)
+        valid = (positions >= 0) & (positions < len(self.signal))
+        values = self.signal[np.clip(positions, 0, len(self.signal) - 1)]
+        if channel is not None:
+            values = values[:, :, channel]
+        elif values.shape[2] == 1:
+            values = values[:, :, 0]
+        else:
+            values = np.mean(values, 2)
+
+        signs = np.sign(values)
+        crossings = (signs[:, 1:] != signs[:, :-1]) & valid[:, 1:] & valid[:, :-1]
+        found = np.any(crossings, 1)
+        i = np.argmax(crossings, 1)
+
+        rows = np.arange(len(ts))
+        prev = np.abs(values[rows, i])
+        cur = np.abs(values[rows, i + 1])
+        snapped = np.where(prev < cur, ts + i - 1, ts + i)
+
+        return np.where(found, snapped, ts)
 
     def crop(self, start=None, end=None, zero_crossing=False):
         if start is None:
@@ -59,7 +150,7 @@ class Audio(object):
             start = self.find_zero_crossing(start)
             end = self.find_zero_crossing(end)
         signal = self.signal[start:end]
-        signal = signal.astype('float32')
+        signal = signal.astype('float32', copy=False)
         return Audio(signal, self.sample_rate)
 
     def crop_seconds(self, start, end=None):
@@ -68,31 +159,56 @@ class Audio(object):
             end *= int(self.sample_rate)
         return self.crop(start, end)
 
-    def add_at(self, other, t):
+    def add_at(self, other, t, inplace=False):
+        # with inplace, the signal grows into an over-allocated buffer so
+        # that mixing many clips into one Audio doesn't copy it every time
         assert self.sample_rate == other.sample_rate
         s1 = self.signal
         s2 = other.signal
         assert s1.shape[1] == s2.shape[1]
 
-        if t + len(s2) > len(s1):
-            signal = np.vstack((s1, np.zeros((t + len(s2) - len(s1), s1.shape[1]))))
+        end = t + len(s2)
+        if inplace:
+            self._reserve(end)
+            signal = self.signal
         else:
-            signal = s1.copy()
+            signal = np.zeros((max(len(s1), end), s1.shape[1]), dtype='float32')
+            signal[:len(s1)] = s1
 
-        signal[t:t + len(s2), :] += s2
-        signal = signal.astype('float32')
+        signal[t:end, :] += s2
 
-        return Audio(signal, self.sample_rate)
+        return self._result(signal, inplace)
+
+    def add_after(self, other, inplace=False):
+        return self.add_at(other, len(self.signal), inplace)
 
-    def add_after(self, other):
-        return self.add_at(other, len(self.signal))
+    def _reserve(self, length):
+        if length <= len(self.signal):
+            return
+        buffer = getattr(self, '_buffer', None)
+        if buffer is None or self.signal.base is not buffer or len(buffer) < length:
+            buffer = np.zeros((max(length, 2 * len(self.signal)), self.signal.shape[1]),
+                              dtype='float32')
+            buffer[:len(self.signal)] = self.signal
+            self._buffer = buffer
+        self.signal = buffer[:length]
 
-    def normalise(self, peak=1.0):
-        factor = peak / np.max(np.abs(self.signal))
-        return Audio(self.signal * factor, self.sample_rate)
+    def normalise(self, peak=1.0, inplace=False, out=None):
+        factor = peak / max(np.max(self.signal), -np.min(self.signal))
+        if inplace:
+            out = self.signal
+        signal = np.multiply(self.signal, factor, out=out)
+        return self._result(signal, inplace)
 
-    def clip(self, peak=1.0):
-        signal = np.maximum(np.minimum(self.signal, 1), -1)
+    def clip(self, peak=1.0, inplace=False, out=None):
+        if inplace:
+            out = self.signal
+        signal = np.clip(self.signal, -peak, peak, out=out)
+        return self._result(signal, inplace)
+
+    def _result(self, signal, inplace):
+        if inplace:
+            return self
         return Audio(signal, self.sample_rate)
 
     def play(self):
@@ -101,38 +217,416 @@ class Audio(object):
             subprocess.check_call(['aplay', filename])
 
     def copy(self):
-        return Audio(self.signal, self.sample_rate)
+        return Audio(np.array(self.signal), self.sample_rate)
+
+# gathered input values (16 MB of float32) per resampling step
+RESAMPLE_BLOCK_VALUES = 2**22
 
-def read(filename):
+# (up, down) -> (polyphase filter, half length)
+_resample_filters = {}
+
+def get_resample_filter(up, down, half_len_factor=10, beta=5.0):
+    # kaiser windowed lowpass at the lower of the two nyquist rates,
+    # the same design as scipy.signal.resample_poly. returned as an
+    # (up, taps) polyphase bank where bank[p, q] = h[p + q * up]
+    key = (up, down, half_len_factor, beta)
+    if key not in _resample_filters:
+        max_rate = max(up, down)
+        half_len = half_len_factor * max_rate
+        h = scipy.signal.firwin(2 * half_len + 1, 1.0 / max_rate,
+                                window=('kaiser', beta)) * up
+        n_taps = -(-len(h) // up)
+        h = np.append(h, np.zeros(n_taps * up - len(h)))
+        _resample_filters[key] = h.reshape((n_taps, up)).T.copy(), half_len
+    return _resample_filters[key]
+
+# samples rendered per block by Mixer.iter_blocks
+MIXER_BLOCK_SAMPLES = 2**16
+
+class Mixer(object):
+    # places many clips on a timeline and renders them in one pass into
+    # a single preallocated buffer, or block by block
+
+    def __init__(self, sample_rate, channels=1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        # (audio, start, end, offset, gain)
+        self.placements = []
+
+    def add(self, audio, offset, gain=1.0, start=None, end=None, zero_crossing=False):
+        # places audio.signal[start:end] at offset samples, with the cut
+        # points snapped to zero crossings like Audio.crop
+        assert audio.sample_rate == self.sample_rate
+        assert audio.signal.shape[1] == self.channels
+
+        if start is None:
+            start = 0
+        if end is None:
+            end = len(audio.signal)
+        if zero_crossing:
+            start = audio.find_zero_crossing(start)
+            end = audio.find_zero_crossing(end)
+        # out of range cut points are clamped like slicing in Audio.crop
+        start = min(max(int(start), 0), len(audio.signal))
+        end = min(max(int(end), 0), len(audio.signal))
+        if start > end:
+            raise AudioException('Mixer clip start %d is after its end %d' % (start, end))
+
+        self.placements.append((audio, start, end, int(offset), gain))
+
+    def add_seconds(self, audio, offset, gain=1.0, **kwargs):
+        self.add(audio, int(offset * self.sample_rate), gain, **kwargs)
+
+    def __len__(self):
+        return max([offset + end - start
+                    for _, start, end, offset, _ in self.placements] or [0])
+
+    def render(self):
+        signal = np.zeros((len(self), self.channels), dtype='float32')
+        for placement in self.placements:
+            _mix_into(signal, 0, *placement)
+        return Audio(signal, self.sample_rate)
+
+    def iter_blocks(self, block_samples=MIXER_BLOCK_SAMPLES):
+        length = len(self)
+        placements = sorted(self.placements, key=lambda p: p[3])
+        active = []
+        next_x = 0
+
+        for block_start in xrange(0, length, block_samples):
+            block_end = min(block_start + block_samples, length)
+            while next_x < len(placements) and placements[next_x][3] < block_end:
+                active.append(placements[next_x])
+                next_x += 1
+            active = [p for p in active if p[3] + p[2] - p[1] > block_start]
+
+            block = np.zeros((block_end - block_start, self.channels), dtype='float32')
+            for placement in active:
+                _mix_into(block, block_start, *placement)
+            yield block
+
+    def write(self, filename, sample_format='float32', dither=False):
+        # wav files are written block by block without rendering the
+        # whole mix in memory
+        filename = os.path.expanduser(filename)
+        if os.path.splitext(filename)[1] == '.wav':
+            write_wav_blocks(filename, self.iter_blocks(), self.sample_rate,
+                             sample_format, dither, channels=self.channels)
+        else:
+            self.render().write(filename)
+
+def _mix_into(out, out_start, audio, start, end, offset, gain):
+    # adds the part of audio.signal[start:end], placed at offset, that
+    # overlaps out, which covers out_start onwards
+    first = max(offset, out_start)
+    last = min(offset + end - start, out_start + len(out))
+    if first >= last:
+        return
+    clip = audio.signal[start + first - offset:start + last - offset]
+    target = out[first - out_start:last - out_start]
+    if gain == 1:
+        target += clip
+    else:
+        target += clip * gain
+
+# samples converted and written per block by Audio.write
+WAV_BLOCK_SAMPLES = 2**16
+
+# sample format -> (wav format tag, bytes per sample)
+WAV_SAMPLE_FORMATS = {
+    'float32': (3, 4),
+    'int16': (1, 2),
+    'int24': (1, 3),
+    'int32': (1, 4),
+}
+
+# largest value of the 32 bit riff and data chunk size fields
+WAV_MAX_RIFF_SIZE = 0xFFFFFFFF
+
+class WavWriter(object):
+    # incremental wav writer. blocks of (samples, channels) floats in
+    # [-1, 1] are converted to sample_format and appended, and the
+    # header sizes are filled in on close. dither adds triangular
+    # noise of one least significant bit before integer rounding
+
+    def __init__(self, filename, sample_rate, channels, sample_format='float32',
+                 dither=False, seed=None):
+        if sample_format not in WAV_SAMPLE_FORMATS:
+            raise AudioException('Unknown sample format: %s' % sample_format)
+        self.sample_rate = int(sample_rate)
+        self.channels = channels
+        self.sample_format = sample_format
+        self.dither = dither
+        self.random = np.random.RandomState(seed)
+        self.format_tag, self.sample_width = WAV_SAMPLE_FORMATS[sample_format]
+        self.n_samples = 0
+
+        self.f = open(os.path.expanduser(filename), 'wb')
+        self._write_header()
+        # the riff size field counts everything after itself, including
+        # a padding byte after odd sized data
+        self.max_data_size = WAV_MAX_RIFF_SIZE - (self.f.tell() - 8) - 1
+
+    def _write_header(self):
+        block_align = self.channels * self.sample_width
+        data_size = self.n_samples * block_align
+        fmt = struct.pack('<HHIIHH', self.format_tag, self.channels, self.sample_rate,
+                          self.sample_rate * block_align, block_align,
+                          self.sample_width * 8)
+        if self.format_tag == 3:
+            # non-pcm formats carry a cbSize field and a fact chunk
+            fmt += struct.pack('<H', 0)
+            fact = b'fact' + struct.pack('<II', 4, self.n_samples)
+        else:
+            fact = b''
+        header = (b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + fact +
+                  b'data' + struct.pack('<I', data_size))
+        riff_size = len(header) + data_size + data_size % 2
+
+        self.f.seek(0)
+        self.f.write(b'RIFF' + struct.pack('<I', riff_size) + header)
+
+    def write(self, block):
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        if block.shape[1] != self.channels:
+            raise AudioException('Expected %d channels, got %d' %
+                                 (self.channels, block.shape[1]))
+        block_align = self.channels * self.sample_width
+        if (self.n_samples + len(block)) * block_align > self.max_data_size:
+            raise AudioException('Wav data would exceed the 4 GiB size limit')
+        self.f.write(self._convert(block).tobytes())
+        self.n_samples += len(block)
+
+    def _convert(self, block):
+        if self.sample_format == 'float32':
+            return block.astype('<f4', copy=False)
+
+        bits = self.sample_width * 8
+        scale = 2 ** (bits - 1)
+        samples = block * float(scale)
+        if self.dither:
+            samples += self.random.random_sample(samples.shape)
+            samples -= self.random.random_sample(samples.shape)
+        samples = np.round(samples, out=samples)
+        samples = np.clip(samples, -scale, scale - 1, out=samples)
+
+        if self.sample_format == 'int16':
+            return samples.astype('<i2')
+        samples = samples.astype('<i4')
+        if self.sample_format == 'int24':
+            # low three bytes of each little-endian int32
+            return samples.view(np.uint8).reshape(samples.shape + (4,))[..., :3]
+        return samples
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            data_size = self.n_samples * self.channels * self.sample_width
+            if data_size % 2:
+                self.f.write(b'\0')
+            self._write_header()
+        finally:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def write_wav_blocks(filename, blocks, sample_rate, sample_format='float32',
+                     dither=False, channels=None):
+    # writes an iterable of (samples, channels) blocks, such as
+    # Mixer.iter_blocks(), without holding the whole signal in memory
+    writer = None
+    try:
+        for block in blocks:
+            if writer is None:
+                if channels is None:
+                    channels = block.shape[1] if np.ndim(block) == 2 else 1
+                writer = WavWriter(filename, sample_rate, channels, sample_format, dither)
+            writer.write(block)
+        if writer is None:
+            writer = WavWriter(filename, sample_rate, channels or 1, sample_format, dither)
+    finally:
+        if writer is not None:
+            writer.close()
+
+class LazySignal(object):
+    # memory-mapped pcm data that is only scaled to float32 when sliced
+
+    def __init__(self, raw, scale=1.0):
+        if len(raw.shape) == 1:
+            raw = raw[:, np.newaxis]
+        self.raw = raw
+        self.scale = scale
+        self.shape = raw.shape
+        self.ndim = 2
+        self.dtype = np.dtype('float32')
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        signal = np.array(self.raw[key], dtype='float32')
+        if self.scale != 1:
+            signal *= self.scale
+        return signal
+
+    def __array__(self, dtype=None):
+        signal = self[:]
+        if dtype is not None:
+            signal = signal.astype(dtype)
+        return signal
+
+    def get_channel(self, channel_x):
+        return LazySignal(self.raw[:, channel_x], self.scale)
+
+def read(filename, lazy=False, start=None, duration=None,
+         sample_rate=None, channels=None):
     filename = os.path.expanduser(filename)
     _, extension = os.path.splitext(filename)
+    decode_options = (start, duration, sample_rate, channels)
     if extension in ['.mp3', '.mp4']:
-        return _read_mpX(filename)
+        return _read_mpX(filename, *decode_options)
     elif extension == '.wav':
-        return _read_wav(filename)
+        if any(x is not None for x in decode_options):
+            return _read_mpX(filename, *decode_options)
+        return _read_wav(filename, lazy)
     else:
         raise NotImplementedError('Unknown file extension: %s (%s)' %
                                   (extension, filename))
 
-def _read_mpX(filename):
-    with util.temporary_filename('.wav') as wav_filename:
-        subprocess.check_output(['ffmpeg', '-y', '-i', filename, wav_filename], stderr=subprocess.STDOUT)
-        return _read_wav(wav_filename)
+def read_blocks(filename, block_samples, start=None, duration=None,
+                sample_rate=None, channels=None):
+    filename = os.path.expanduser(filename)
+    with _ffmpeg_decoder(filename, start, duration, sample_rate, channels) as (
+            stream, sample_rate, channels):
+        block_bytes = block_samples * channels * 4
+        while True:
+            data = _read_exactly(stream, block_bytes)
+            if len(data) < channels * 4:
+                break
+            yield _pcm_to_signal(data, channels)
+
+def _read_mpX(filename, start=None, duration=None, sample_rate=None, channels=None):
+    with _ffmpeg_decoder(filename, start, duration, sample_rate, channels) as (
+            stream, sample_rate, channels):
+        data = bytearray()
+        while True:
+            chunk = stream.read(PIPE_BUFFER_SIZE)
+            if not chunk:
+                break
+            data.extend(chunk)
+    return Audio(_pcm_to_signal(data, channels), sample_rate)
+
+@contextmanager
+def _ffmpeg_decoder(filename, start=None, duration=None, sample_rate=None, channels=None):
+    # decodes to a float32 wav stream on stdout, which is parsed up to
+    # the data chunk so the caller can read raw f32le samples
+    command = [FFMPEG]
+    if start is not None:
+        command += ['-ss', str(start)]
+    command += ['-i', filename]
+    if duration is not None:
+        command += ['-t', str(duration)]
+    if sample_rate is not None:
+        command += ['-ar', str(sample_rate)]
+    if channels is not None:
+        command += ['-ac', str(channels)]
+    command += ['-vn', '-f', 'wav', '-acodec', 'pcm_f32le', 'pipe:1']
+
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            try:
+                sample_rate, channels = _read_wav_stream_header(process.stdout)
+            except AudioException:
+                _check_process(process, command, stderr)
+                raise
+            yield process.stdout, sample_rate, channels
+        except:
+            process.stdout.close()
+            process.wait()
+            raise
+        process.stdout.close()
+        _check_process(process, command, stderr)
 
-def _read_wav(filename):
-    sample_rate, signal = scipy.io.wavfile.read(filename)
-    if signal.dtype == 'int16':
-        signal = signal.astype(float) / (2**15)
-    elif signal.dtype == 'int32':
-        signal = signal.astype(float) / (2**31)
+def _read_wav_stream_header(stream):
+    riff = _read_exactly(stream, 12)
+    if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise AudioException('Decoder did not produce a wav stream')
 
-    if np.max(signal) > 1 or np.min(signal) < -1:
+    sample_rate = channels = None
+    while True:
+        header = _read_exactly(stream, 8)
+        if len(header) < 8:
+            raise AudioException('Decoder produced no audio data')
+        chunk_id, size = struct.unpack('<4sI', bytes(header))
+        if chunk_id == b'data':
+            break
+        chunk = _read_exactly(stream, size + size % 2)
+        if chunk_id == b'fmt ':
+            _, channels, sample_rate = struct.unpack('<HHI', bytes(chunk[:8]))
+            bits, = struct.unpack('<H', bytes(chunk[14:16]))
+            if bits != 32:
+                raise AudioException('Expected 32 bit float samples, got %d bits' % bits)
+
+    if channels is None:
+        raise AudioException('No fmt chunk in wav stream')
+
+    return sample_rate, channels
+
+def _read_exactly(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data.extend(chunk)
+    return data
+
+def _pcm_to_signal(data, channels):
+    n_samples = len(data) // (4 * channels)
+    signal = np.frombuffer(data, dtype='<f4', count=n_samples * channels)
+    return signal.reshape((n_samples, channels)).astype('float32', copy=False)
+
+def _check_process(process, command, stderr):
+    if process.wait() != 0:
+        stderr.seek(0)
+        raise subprocess.CalledProcessError(process.returncode, command,
+                                            output=stderr.read())
+
+# scale factors from integer pcm to [-1, 1]
+WAV_SCALES = {
+    'int16': 1.0 / 2**15,
+    'int32': 1.0 / 2**31,
+    'float32': 1.0,
+    'float64': 1.0,
+}
+
+def _read_wav(filename, lazy=False):
+    sample_rate, signal = scipy.io.wavfile.read(filename, mmap=lazy)
+
+    if lazy:
+        if signal.dtype.name not in WAV_SCALES:
+            raise AudioException('Unknown data type')
+        return Audio(LazySignal(signal, WAV_SCALES[signal.dtype.name]), sample_rate)
+
+    if signal.dtype in ('int16', 'int32'):
+        scale = WAV_SCALES[signal.dtype.name]
+        signal = signal.astype('float32')
+        signal *= scale
+    elif np.max(signal) > 1 or np.min(signal) < -1:
         raise AudioException('Unknown data type')
 
     if len(signal.shape) == 1:
         signal = signal[:,np.newaxis]
 
-    signal = signal.astype('float32')
+    signal = signal.astype('float32', copy=False)
 
     return Audio(signal, sample_rate)
     
@@ -1,16 +1,31 @@
 import numpy as np
 from andreasmusic import pitches
 
+# (window_size, sample_rate, bins, base) -> spectrogram bin to chroma bin matrix
+_chroma_matrices = {}
+
 def get_chromagram(spectrogram, sample_rate, tuned=False, tuning_bins=5,
                    bins=12, base=pitches.C4.fq):
     window_size = spectrogram.shape[1] * 2
-    length = spectrogram.shape[0]
 
     if tuned:
         bins *= tuning_bins
 
-    chromagram = np.zeros((length, bins))
+    chromagram = spectrogram.dot(get_chroma_matrix(window_size, sample_rate, bins, base))
+
+    if tuned:
+        chromagram, _ = tune_chromagram(chromagram, tuning_bins)
+
+    return chromagram
+
+def get_chroma_matrix(window_size, sample_rate, bins=12, base=pitches.C4.fq):
+    key = (window_size, sample_rate, bins, base)
+    if key not in _chroma_matrices:
+        _chroma_matrices[key] = _fold_matrix(
+            _get_chroma_indices(window_size, sample_rate, bins, base), bins)
+    return _chroma_matrices[key]
 
+def _get_chroma_indices(window_size, sample_rate, bins, base):
     # create an index array, mapping each spectrogram bin index
     # to a chromagram bin index
     indices = np.mod(
@@ -23,14 +38,14 @@ def get_chromagram(spectrogram, sample_rate, tuned=False, tuning_bins=5,
              ), bins).astype(int)
              
     indices = np.insert(indices, 0, 0) # arbitrarily set fq 0 to c
+    return indices
 
-    for i in xrange(length):
-        chromagram[i, :] = np.bincount(indices, weights=spectrogram[i, :])
-        
-    if tuned:
-        chromagram, _ = tune_chromagram(chromagram, tuning_bins)
-
-    return chromagram
+def _fold_matrix(indices, bins):
+    # one-hot (len(indices), bins) matrix, x.dot(m) is the same as
+    # np.bincount(indices, weights=x) for every row x
+    matrix = np.zeros((len(indices), bins))
+    matrix[np.arange(len(indices)), indices] = 1
+    return matrix
 
 def tune_chromagram(chromagram, tuning_bins=5):
     assert chromagram.shape[1] % tuning_bins == 0
@@ -40,9 +55,7 @@ def tune_chromagram(chromagram, tuning_bins=5):
     actual_bins = chromagram.shape[1] / tuning_bins
     indices = _get_tuning_indices(actual_bins, tuning_bins, tuning)
 
-    tuned = np.zeros((len(chromagram), actual_bins))
-    for i in xrange(len(chromagram)):
-        tuned[i] = np.bincount(indices, weights=chromagram[i])
+    tuned = chromagram.dot(_fold_matrix(indices, actual_bins))
 
     return tuned, tuning
 
@@ -1,7 +1,11 @@
 # emphasis on the harmony, more than anything else
 
+import os
 import midi
 import numpy as np
+import binascii
+import StringIO
+import struct
 import collections
 import subprocess
 
@@ -51,39 +55,113 @@ TRANSIENT_PROGRAMS = {
 CONTROL_VOLUME = 7
 CONTROL_BANK_SELECT = 0
 
-def read(filename, oversampling=1):
-    raw = midi.read_midifile(filename)
-    raw.make_ticks_abs()
-
-    length, resolution = get_length(raw)
+TIMIDITY = 'timidity'
+
+SYNTH_SAMPLE_RATE = 44100
+# relative amplitudes of the overtones of the built in synthesizer
+SYNTH_HARMONICS = (1.0, 0.5, 0.3, 0.2, 0.1, 0.05)
+SYNTH_GAIN = 0.1
+SYNTH_RAMP_SECONDS = 0.005
+
+# samples per cycle when finding the peak of the synthesizer's waveform
+PEAK_SEARCH_SAMPLES = 2048
+
+# bytes of wavetables kept by get_wavetable, least recently used first out
+WAVETABLE_CACHE_BYTES = 2**27
+
+_wavetables = collections.OrderedDict()
+
+# ticks per beat and per frame of written pitchgrams
+PITCHGRAM_RESOLUTION = 96
+
+# note intervals in absolute ticks, program is -1 before any program change
+NOTE_DTYPE = np.dtype([
+    ('pitch', np.int16),
+    ('start', np.int64),
+    ('end', np.int64),
+    ('velocity', np.int8),
+    ('channel', np.int8),
+    ('program', np.int16),
+])
+
+TEMPO_DTYPE = np.dtype([
+    ('tick', np.int64),
+    ('bpm', np.float64),
+])
+
+TIME_SIGNATURE_DTYPE = np.dtype([
+    ('tick', np.int64),
+    ('numerator', np.int16),
+    ('denominator', np.int16),
+    ('metronome', np.int16),
+    ('thirtyseconds', np.int16),
+])
+
+MIDI_EXTENSIONS = {'.mid', '.midi'}
+
+Scan = collections.namedtuple('Scan', [
+    'max_tick', 'resolution', 'time_signatures', 'tempos', 'notes'])
+
+def read(filename, oversampling=1, frame_seconds=None):
+    # with frame_seconds (e.g. hop_size / float(sample_rate)) frames are
+    # spaced in seconds through the tempo map instead of in beats
+    scanned = scan(midi.read_midifile(filename))
+
+    if frame_seconds is None:
+        tempo_map = None
+        length, resolution = get_scan_length(scanned)
+    else:
+        tempo_map = get_tempo_map(scanned.tempos, scanned.resolution)
+        duration = ticks_to_seconds(scanned.max_tick, tempo_map)
+        length, resolution = int(duration / frame_seconds) + 1, frame_seconds
     resolution /= oversampling
     length *= oversampling
 
-    tempos = []
+    pitches = rasterize(scanned.notes, length, resolution, tempo_map)
+
+    pitches = lower_resolution(pitches, oversampling)
 
-    pitches = np.zeros((length, MAX_PITCH - MIN_PITCH), dtype=np.float32)
+    return pitches, scanned.tempos.tolist()
 
-    for track_number, track in enumerate(raw):
+def scan(raw):
+    # collects everything read needs from a pattern in a single pass over
+    # its events, with either relative or absolute ticks, without mutating
+    # it. repeated note ons of a sounding pitch are ignored, and notes that
+    # are never turned off sound through the last tick of their track
+    max_tick = 0
+    notes = []
+    tempos = []
+    time_signatures = []
+
+    for track in raw:
         tick = 0
         programs = {}
-        channel_active_pitches = collections.defaultdict(set)
+        # (channel, pitch) -> (start tick, velocity, program)
+        active_notes = {}
 
         for event in track:
-            prev_t = (tick / resolution)
-            tick = event.tick
-            t = int(tick / resolution)
+            if track.tick_relative:
+                tick += event.tick
+            else:
+                tick = event.tick
 
             if isinstance(event, midi.NoteOnEvent):
                 if not is_percussion(programs, event.channel):
                     pitch, velocity = event.data
+                    key = (event.channel, pitch)
                     if velocity == 0:
-                        channel_active_pitches[event.channel].discard(pitch)
-                    else:
-                        channel_active_pitches[event.channel].add(pitch)
+                        if key in active_notes:
+                            start, velocity, program = active_notes.pop(key)
+                            notes.append((pitch, start, tick, velocity, event.channel, program))
+                    elif key not in active_notes:
+                        active_notes[key] = (tick, velocity, programs.get(event.channel, -1))
 
             elif isinstance(event, midi.NoteOffEvent):
                 pitch, _ = event.data
-                channel_active_pitches[event.channel].discard(pitch)
+                key = (event.channel, pitch)
+                if key in active_notes:
+                    start, velocity, program = active_notes.pop(key)
+                    notes.append((pitch, start, tick, velocity, event.channel, program))
 
             elif isinstance(event, midi.ProgramChangeEvent):
                 programs[event.channel] = event.data[0]
@@ -91,81 +169,291 @@ def read(filename, oversampling=1):
             elif isinstance(event, midi.SetTempoEvent):
                 tempos.append((tick, event.get_bpm()))
 
-            active_pitches = set()
-            for channel, ap in channel_active_pitches.items():
-                active_pitches |= ap
-
-            for p in active_pitches:
-                if MIN_PITCH <= p < MAX_PITCH:
-                    pitches[t, p - MIN_PITCH] = min(1, pitches[t, p - MIN_PITCH] + 1)
-
-            # for channel, active_pitches in channel_active_pitches.items():
-            #     # TODO: decide whether or not to keep this. i'm leaning towards
-            #     # only counting note on messages since people never write note off...
-            #     if False and ( channel in programs and programs[channel] in TRANSIENT_PROGRAMS and t != prev_t):
-            #         channel_active_pitches[channel] = set()
-
-    pitches = lower_resolution(pitches, oversampling)
-
-    return pitches, tempos
+            elif isinstance(event, midi.TimeSignatureEvent):
+                time_signatures.append((tick, event.numerator, event.denominator,
+                                        event.metronome, event.thirtyseconds))
+
+        for (channel, pitch), (start, velocity, program) in active_notes.items():
+            notes.append((pitch, start, tick + 1, velocity, channel, program))
+
+        max_tick = max(max_tick, tick)
+
+    notes = np.array(notes, dtype=NOTE_DTYPE)
+    notes.sort(order=['start', 'pitch'])
+    tempos = np.array(tempos, dtype=TEMPO_DTYPE)
+    time_signatures = np.array(time_signatures, dtype=TIME_SIGNATURE_DTYPE)
+
+    return Scan(max_tick, raw.resolution, time_signatures, tempos, notes)
+
+def rasterize(notes, length, resolution, tempo_map=None):
+    # (length, RANGE) pitchgram with a 1 in every frame that a note
+    # overlaps, frame i covering ticks [i * resolution, (i + 1) * resolution),
+    # or seconds if a tempo map is given. note starts and ends are scattered
+    # into a difference array and integrated with a cumulative sum
+    notes = notes[(notes['pitch'] >= MIN_PITCH) & (notes['pitch'] < MAX_PITCH)]
+    pitches = notes['pitch'] - MIN_PITCH
+    starts = notes['start']
+    ends = notes['end']
+    if tempo_map is not None:
+        starts = ticks_to_seconds(starts, tempo_map)
+        ends = ticks_to_seconds(ends, tempo_map)
+    starts = np.floor(starts / float(resolution)).astype(int)
+    ends = np.ceil(ends / float(resolution)).astype(int)
+    ends = np.maximum(ends, starts + 1)
+
+    counts = np.zeros((length + 1, RANGE), dtype=np.int32)
+    np.add.at(counts, (np.minimum(starts, length), pitches), 1)
+    np.add.at(counts, (np.minimum(ends, length), pitches), -1)
+
+    return (np.cumsum(counts[:-1], 0) > 0).astype(np.float32)
+
+def get_tempo_map(tempos, resolution, default_bpm=120):
+    # (tick, seconds, seconds per tick) at every tempo change, for
+    # piecewise linear tick to seconds conversion. the last of several
+    # changes at the same tick wins
+    tempos = tempos[np.argsort(tempos['tick'], kind='mergesort')]
+    ticks = np.concatenate(([0], tempos['tick']))
+    bpms = np.concatenate(([default_bpm], tempos['bpm']))
+    last = np.append(ticks[1:] != ticks[:-1], True)
+    ticks = ticks[last]
+    seconds_per_tick = 60.0 / (bpms[last] * resolution)
+
+    seconds = np.zeros(len(ticks))
+    seconds[1:] = np.cumsum(np.diff(ticks) * seconds_per_tick[:-1])
+
+    return ticks, seconds, seconds_per_tick
+
+def ticks_to_seconds(ticks, tempo_map):
+    map_ticks, seconds, seconds_per_tick = tempo_map
+    i = np.searchsorted(map_ticks, ticks, side='right') - 1
+    return seconds[i] + (ticks - map_ticks[i]) * seconds_per_tick[i]
 
 def lower_resolution(pitchgram, factor):
-    return np.array([
-        x.sum(0) for x in np.split(pitchgram, range(factor, len(pitchgram), factor))
-    ])
+    # sums every block of factor frames, zero padding the last partial block
+    pitchgram = np.asarray(pitchgram)
+    padding = -len(pitchgram) % factor
+    if padding:
+        pitchgram = np.vstack((pitchgram, np.zeros((padding,) + pitchgram.shape[1:], pitchgram.dtype)))
+    return pitchgram.reshape((-1, factor) + pitchgram.shape[1:]).sum(1)
 
 def pitch_to_int(p):
-    return np.dot(np.power(2, np.arange(len(p) - 1, -1, -1)), p)
+    # the first pitch is the most significant bit. exact for any number
+    # of pitches; a pitchgram gives one int per frame
+    keys = pitch_to_keys(p)
+    ints = [int(binascii.hexlify(k.tostring()) or '0', 16) for k in keys]
+    if np.ndim(p) == 1:
+        return ints[0]
+    return ints
+
+def pitch_to_keys(pitchgram):
+    # packs every frame into a fixed width big-endian byte string, one bit
+    # per sounding pitch, so frames can be compared, sorted and counted
+    bits = np.atleast_2d(pitchgram) != 0
+    padding = -bits.shape[1] % 8
+    bits = np.hstack((np.zeros((len(bits), padding), dtype=bool), bits))
+    packed = np.ascontiguousarray(np.packbits(bits, axis=1))
+    return packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+def count_chords(pitchgram):
+    # distinct frames of a pitchgram and how many times each occurs
+    keys = pitch_to_keys(pitchgram)
+    keys, indices, counts = np.unique(keys, return_index=True, return_counts=True)
+    return np.atleast_2d(pitchgram)[indices] != 0, counts
 
 def get_length(raw):
-    max_length = 0
-    resolution = raw.resolution
-    metronome = None
-    for track in raw:
-        t = 0
-        for event in track:
-            t = event.tick
-            if isinstance(event, midi.TimeSignatureEvent):
-                if metronome is None:
-                    metronome = event.metronome
-                elif metronome != event.metronome:
-                    raise MultipleMetronomesError
-        if t > max_length:
-            max_length = t
-
-    if metronome is None:
-        metronome = 24
+    return get_scan_length(scan(raw))
+
+def get_scan_length(scanned):
+    metronomes = set(scanned.time_signatures['metronome'].tolist())
+    if len(metronomes) > 1:
+        raise MultipleMetronomesError
+
+    metronome = metronomes.pop() if metronomes else 24
 
     if metronome != 24:
         print '--------- metronome %d != 24' % metronome
         metronome = 24 #####
 
-    resolution = resolution * (metronome / 24.0)
+    resolution = scanned.resolution * (metronome / 24.0)
  
-    return int(max_length / resolution) + 1, resolution
+    return int(scanned.max_tick / resolution) + 1, resolution
 
 class MultipleMetronomesError(Exception): pass
 
 def is_percussion(programs, channel):
     return programs.get(channel, 0) >= 112 or channel == 9
         
+def scan_file(filename):
+    return scan(midi.read_midifile(filename))
+
+def write_note_table(directory, filename, n_workers=None):
+    # scans every midi file in directory across a process pool into one
+    # columnar .npz note table. file_id indexes the filenames and
+    # resolutions columns. returns the failed BatchResults
+    filenames = sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if os.path.splitext(f)[1].lower() in MIDI_EXTENSIONS)
+
+    scanned = collections.OrderedDict()
+    def sink(midi_filename, value):
+        scanned[midi_filename] = value
+
+    failures = util.run_batch(scan_file, filenames, sink, n_workers=n_workers,
+                              ordered=True)
+
+    notes = [s.notes for s in scanned.values()]
+    file_ids = [np.repeat(i, len(n)) for i, n in enumerate(notes)]
+    notes = np.concatenate(notes or [np.zeros(0, NOTE_DTYPE)])
+    columns = {name: notes[name] for name in NOTE_DTYPE.names}
+
+    with util.atomic_write(filename) as f:
+        np.savez(f,
+                 file_id=np.concatenate(file_ids or [[]]).astype(np.int32),
+                 filenames=np.array(scanned.keys(), dtype=str),
+                 resolutions=np.array([s.resolution for s in scanned.values()], dtype=np.int32),
+                 **columns)
+
+    return failures
+
 def play(pitchgram, transpose=0, tempo=120, instrument=41):
     with util.temporary_filename() as filename:
         write_pitchgram(pitchgram, filename, transpose, tempo=tempo, instrument=instrument)
-        subprocess.check_output(['timidity', filename])
+        subprocess.check_output([TIMIDITY, filename])
+
+def synthesize_audio(pitchgram, transpose=0, tempo=120, instrument=41,
+                     synthesizer='timidity'):
+    # synthesizer is 'timidity' (through temporary files), 'timidity_pipe'
+    # (through stdin and stdout) or 'wavetable', the built in synthesizer
+    # that ignores instrument but needs neither timidity nor the disk
+    if synthesizer == 'wavetable':
+        return synthesize_wavetable(pitchgram, transpose, tempo)
+    if synthesizer == 'timidity_pipe':
+        return _synthesize_timidity_pipe(pitchgram, transpose, tempo, instrument)
+    if synthesizer != 'timidity':
+        raise ValueError('Unknown synthesizer: %s' % synthesizer)
 
-def synthesize_audio(pitchgram, transpose=0, tempo=120, instrument=41):
     from andreasmusic import audio
 
     with util.temporary_filename('.mid') as midi_filename:
         with util.temporary_filename('.wav') as wav_filename:
             write_pitchgram(pitchgram, midi_filename, transpose, tempo, instrument)
-            subprocess.check_output(['timidity', '-Ow', '-o', wav_filename, midi_filename])
+            subprocess.check_output([TIMIDITY, '-Ow', '-o', wav_filename, midi_filename])
             return audio.read(wav_filename)
 
-def write_pitchgram(pitchgram, filename, transpose=0, tempo=120, instrument=41):
+def _synthesize_timidity_pipe(pitchgram, transpose, tempo, instrument):
+    from andreasmusic import audio
+
+    midi_file = StringIO.StringIO()
+    write_pitchgram(pitchgram, midi_file, transpose, tempo, instrument)
+
+    # raw 16 bit signed little endian mono pcm on stdout
+    command = [TIMIDITY, '-Or1slM', '-s', str(SYNTH_SAMPLE_RATE), '-o', '-', '-']
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    data, stderr = process.communicate(midi_file.getvalue())
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr)
+
+    signal = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+    signal = signal.astype(np.float32) * audio.WAV_SCALES['int16']
+    return audio.Audio(signal[:, np.newaxis], SYNTH_SAMPLE_RATE)
+
+def get_wavetable(fq, frame_samples, sample_rate=SYNTH_SAMPLE_RATE,
+                  harmonics=SYNTH_HARMONICS):
+    # (frame_samples, 2 * len(harmonics)) cosine and sine partials of a
+    # tone at fq over one frame, with peak normalised amplitudes. a frame
+    # starting at phase x is sin(h x) * cosines + cos(h x) * sines
+    key = (fq, frame_samples, sample_rate, tuple(harmonics))
+    if key in _wavetables:
+        _wavetables[key] = _wavetables.pop(key)
+    else:
+        overtones = np.arange(1, len(harmonics) + 1)
+        phases = np.arange(PEAK_SEARCH_SAMPLES) * 2 * np.pi / PEAK_SEARCH_SAMPLES
+        peak = np.abs(np.dot(harmonics, np.sin(np.outer(overtones, phases)))).max()
+        amplitudes = np.asarray(harmonics) / peak
+
+        phases = np.outer(np.arange(frame_samples) * (2 * np.pi * fq / sample_rate), overtones)
+        _wavetables[key] = np.hstack((np.cos(phases) * amplitudes,
+                                      np.sin(phases) * amplitudes)).astype(np.float32)
+        while (len(_wavetables) > 1 and
+               sum(t.nbytes for t in _wavetables.values()) > WAVETABLE_CACHE_BYTES):
+            _wavetables.popitem(last=False)
+    return _wavetables[key]
+
+def synthesize_wavetable(pitchgram, transpose=0, tempo=120,
+                         sample_rate=SYNTH_SAMPLE_RATE, harmonics=SYNTH_HARMONICS):
+    # frames are beats, like in write_pitchgram. pitchgram values are
+    # note gains, clipped to [0, 1]. every frame of the signal is one
+    # matrix product of the frame's partial coefficients with the
+    # wavetables of the sounding pitches
+    from andreasmusic import audio
+
+    pitchgram = np.clip(pitchgram, 0, 1)
+    frame_samples = int(round(sample_rate * 60.0 / tempo))
+    n_frames = len(pitchgram)
+    ramp_samples = min(max(int(sample_rate * SYNTH_RAMP_SECONDS), 1), frame_samples)
+    pitches = np.nonzero(pitchgram.any(0))[0]
+    overtones = np.arange(1, len(harmonics) + 1)
+
+    signal = np.zeros((n_frames, frame_samples), dtype=np.float32)
+    if len(pitches) == 0:
+        return audio.Audio(signal.reshape((-1, 1)), sample_rate)
+
+    fqs = 440.0 * 2 ** ((MIN_PITCH + transpose + pitches - 69) / 12.0)
+    wavetables = np.hstack([get_wavetable(fq, frame_samples, sample_rate, harmonics)
+                            for fq in fqs])
+
+    # (frames, pitches, harmonics) phases at the frame starts
+    phases = (np.arange(n_frames)[:, np.newaxis, np.newaxis] *
+              (2 * np.pi * frame_samples / sample_rate) *
+              fqs[:, np.newaxis] * overtones)
+    phases = np.mod(phases, 2 * np.pi)
+    partials = np.concatenate((np.sin(phases), np.cos(phases)), 2)
+
+    gains = pitchgram[:, pitches] * SYNTH_GAIN
+    coefficients = (partials * gains[:, :, np.newaxis]).reshape((n_frames, -1))
+    signal += np.dot(coefficients.astype(np.float32), wavetables.T)
+
+    # the gain ramps linearly from the previous frame's over the first
+    # ramp_samples of each frame
+    previous_gains = np.vstack((np.zeros((1, len(pitches))), gains[:-1]))
+    changes = np.nonzero((previous_gains != gains).any(1))[0]
+    if len(changes):
+        steps = previous_gains[changes] - gains[changes]
+        coefficients = (partials[changes] * steps[:, :, np.newaxis]).reshape((len(changes), -1))
+        ramps = np.dot(coefficients.astype(np.float32), wavetables[:ramp_samples].T)
+        ramps *= 1 - np.arange(ramp_samples, dtype=np.float32) / ramp_samples
+        signal[changes, :ramp_samples] += ramps
+
+    return audio.Audio(signal.reshape((-1, 1)), sample_rate)
+
+def get_pitchgram_events(pitchgram, threshold=0.5):
+    # (frames, pitch indices, is note on) of every note on and off, ordered
+    # by frame with note ons first. a pitch sounds while its value is above
+    # threshold, and notes still sounding at the end are turned off after
+    # the last frame
+    active = np.asarray(pitchgram) > threshold
+    edges = np.zeros((len(active) + 2, active.shape[1]), dtype=np.int8)
+    edges[1:-1] = active
+    diffs = np.diff(edges, axis=0)
+
+    frames, pitches = np.nonzero(diffs)
+    is_on = diffs[frames, pitches] > 0
+    order = np.lexsort((pitches, ~is_on, frames))
+    return frames[order], pitches[order], is_on[order]
+
+def _get_pitchgram_deltas(pitchgram, frames):
+    # delta ticks of the events, and of the end of track one frame after
+    # the pitchgram
+    ticks = np.concatenate(([0], frames * PITCHGRAM_RESOLUTION,
+                            [(len(pitchgram) + 1) * PITCHGRAM_RESOLUTION]))
+    deltas = np.diff(ticks)
+    return deltas[:-1], deltas[-1]
+
+def write_pitchgram(pitchgram, filename, transpose=0, tempo=120, instrument=41,
+                    threshold=0.5):
     pattern = midi.Pattern()
-    pattern.resolution = 96
+    pattern.resolution = PITCHGRAM_RESOLUTION
 
     track = midi.Track()
     pattern.append(track)
@@ -174,31 +462,66 @@ def write_pitchgram(pitchgram, filename, transpose=0, tempo=120, instrument=41):
 
     track.append(midi.SetTempoEvent(bpm=tempo))
 
-    diffs = pitchgram - np.vstack((np.zeros((1, pitchgram.shape[1])), pitchgram[:-1]))
-
-    tick = 0
-    tick_increment = 24 * 4
-    #tick_increment = 12
-    for diff in diffs:
-        pitches_on = np.where(diff == 1)[0]
-        pitches_off = np.where(diff == -1)[0]
+    frames, pitches, is_on = get_pitchgram_events(pitchgram, threshold)
+    deltas, end_delta = _get_pitchgram_deltas(pitchgram, frames)
+    pitches = pitches + MIN_PITCH + transpose
 
-        for pitch in pitches_on:
-            on = midi.NoteOnEvent(tick=tick, velocity=100, pitch=MIN_PITCH + transpose + pitch)
-            track.append(on)
-            tick = 0
+    for tick, pitch, on in zip(deltas.tolist(), pitches.tolist(), is_on.tolist()):
+        if on:
+            track.append(midi.NoteOnEvent(tick=tick, velocity=100, pitch=pitch))
+        else:
+            track.append(midi.NoteOffEvent(tick=tick, pitch=pitch))
 
-        for pitch in pitches_off:
-            off = midi.NoteOffEvent(tick=tick, pitch=MIN_PITCH + transpose + pitch)
-            track.append(off)
-            tick = 0
-
-        tick += tick_increment
-
-    tick += tick_increment
-
-    eot = midi.EndOfTrackEvent(tick=tick)
+    eot = midi.EndOfTrackEvent(tick=int(end_delta))
     track.append(eot)
     midi.write_midifile(filename, pattern)
 
     return pattern
+
+def write_pitchgram_raw(pitchgram, filename, transpose=0, tempo=120, instrument=41,
+                        threshold=0.5):
+    with open(filename, 'wb') as f:
+        f.write(pitchgram_to_midi_bytes(pitchgram, transpose, tempo, instrument, threshold))
+
+def pitchgram_to_midi_bytes(pitchgram, transpose=0, tempo=120, instrument=41,
+                            threshold=0.5):
+    # the same file as write_pitchgram, encoded with numpy instead of
+    # midi event objects
+    frames, pitches, is_on = get_pitchgram_events(pitchgram, threshold)
+    deltas, end_delta = _get_pitchgram_deltas(pitchgram, frames)
+    n_events = len(frames)
+
+    # variable length deltas, most significant group first, then status
+    # (left out while it repeats, like midi.FileWriter does), pitch and
+    # velocity
+    events = np.zeros((n_events, 7), dtype=np.uint8)
+    mask = np.zeros((n_events, 7), dtype=bool)
+    for i in xrange(4):
+        shift = 7 * (3 - i)
+        events[:, i] = (deltas >> shift) & 0x7f
+        if i < 3:
+            events[:, i] |= 0x80
+        mask[:, i] = (deltas >> shift) > 0
+    mask[:, 3] = True
+
+    statuses = np.where(is_on, 0x90, 0x80)
+    events[:, 4] = statuses
+    # the program change before the notes has status 0xc0
+    mask[:, 4] = statuses != np.concatenate(([0xc0], statuses[:-1]))
+    events[:, 5] = pitches + MIN_PITCH + transpose
+    events[:, 6] = np.where(is_on, 100, 0)
+    mask[:, 5:] = True
+
+    mpqn = int(6e7 / tempo)
+    track = b''.join([
+        struct.pack('>BBB', 0, 0xc0, instrument),
+        struct.pack('>BBBBBBB', 0, 0xff, 0x51, 3,
+                    (mpqn >> 16) & 0xff, (mpqn >> 8) & 0xff, mpqn & 0xff),
+        events[mask].tostring(),
+        midi.write_varlen(int(end_delta)) + b'\xff\x2f\x00',
+    ])
+
+    return b''.join([
+        b'MThd', struct.pack('>LHHH', 6, 1, 1, PITCHGRAM_RESOLUTION),
+        b'MTrk', struct.pack('>L', len(track)), track,
+    ])
@@ -2,8 +2,10 @@
 
 import numpy as np
 import scipy
+import scipy.sparse
+import scipy.ndimage
 import subprocess
-from scipy.signal import argrelmax, medfilt, medfilt2d
+from scipy.signal import argrelmax, medfilt
 from scipy.cluster.vq import kmeans, vq
 
 from andreasmusic import util
@@ -12,175 +14,503 @@ from andreasmusic import pitches as apitches
 MIN_PITCH = 12 * 3
 MAX_PITCH = 12 * 7
 
-def get_spectrogram(audio, window_size, hop_size, window_function=np.hanning, return_angles=False):
-    if audio.signal.shape[1] != 1:
-        raise NotImplementedError('Only single-channel audio is supported for now')
+# number of frames transformed per batched rfft call, bounds the
+# size of the intermediate windowed and complex arrays
+STFT_BLOCK_FRAMES = 512
 
-    signal = audio.signal[:, 0]
+def get_spectrogram(audio, window_size, hop_size, window_function=np.hanning,
+                    return_angles=False, dtype=np.float64, half_spectrum=False,
+                    downmix=None):
+    # with return_angles and half_spectrum, only the window_size // 2 + 1
+    # non-redundant complex bins are returned. mono audio gives a
+    # (frames, bins) spectrogram, multi-channel audio (channels, frames, bins)
+    # after the optional downmix (see get_channels)
+    signal = get_channels(audio.signal, downmix)
 
     window = window_function(window_size)
-    length = (len(signal) - window_size) // int(hop_size) + 1
-    if return_angles:
-        spectrogram = np.zeros((length, window_size), dtype=np.complex)
-    else:
-        spectrogram = np.zeros((length, window_size // 2))
-
-    for i in xrange(0, length):
-        start = int(round(i * hop_size))
+    frames = _get_frames(_channels_first(signal), window_size, hop_size)
+    spectrogram = _empty_spectrogram(frames.shape[:-1], window_size, return_angles,
+                                     dtype, half_spectrum)
 
-        windowed = signal[start:start + window_size] * window
-        if len(windowed) < window_size:
-            print len(windowed), window_size
-            windowed = np.append(windowed, np.zeros(window_size - len(windowed)))
-
-        fft = scipy.fft(windowed)
-        if return_angles:
-            spectrogram[i, :] = fft
-        else:
-            spectrogram[i, :] = np.abs(fft[:len(fft) / 2])
+    for i in xrange(0, frames.shape[-2], STFT_BLOCK_FRAMES):
+        block = (Ellipsis, slice(i, i + STFT_BLOCK_FRAMES), slice(None))
+        _transform_frames(frames[block], window, return_angles, spectrogram[block])
 
     return spectrogram
 
-def get_variable_spectra(a, split_points):
-    if a.signal.shape[1] != 1:
-        raise NotImplementedError('Only single-channel audio is supported for now')
+DOWNMIXES = ('mean', 'mid', 'side', 'mid_side')
+
+def get_channels(signal, downmix=None):
+    # (samples, channels) signal, optionally downmixed in the time domain
+    # so that the spectrogram is computed once: 'mean' averages all
+    # channels, 'mid', 'side' and 'mid_side' take (l + r) / 2 and
+    # (l - r) / 2 of stereo signals
+    signal = signal[:]
+    if downmix is None:
+        return signal
+    if downmix not in DOWNMIXES:
+        raise ValueError('Unknown downmix: %s' % downmix)
+    if downmix == 'mean':
+        return np.mean(signal, 1)[:, np.newaxis]
+    if signal.shape[1] != 2:
+        raise ValueError('%s downmix requires stereo audio' % downmix)
+
+    mid = (signal[:, 0] + signal[:, 1]) / 2
+    side = (signal[:, 0] - signal[:, 1]) / 2
+    if downmix == 'mid':
+        return mid[:, np.newaxis]
+    elif downmix == 'side':
+        return side[:, np.newaxis]
+    else:
+        return np.vstack((mid, side)).T
+
+def _channels_first(signal):
+    # 1d signal for mono, (channels, samples) otherwise
+    if signal.shape[1] == 1:
+        return signal[:, 0]
+    return signal.T
+
+def iter_spectrogram(source, window_size, hop_size, block_frames=STFT_BLOCK_FRAMES,
+                     window_function=np.hanning, return_angles=False, dtype=np.float64,
+                     half_spectrum=False, downmix=None):
+    # source is an Audio or an iterable of (samples, channels) signal blocks,
+    # such as audio.read_blocks. yields (frames, bins) blocks for mono and
+    # (channels, frames, bins) blocks otherwise, that concatenate along the
+    # frame axis to get_spectrogram
+    window = window_function(window_size)
+    block_samples = max(int(np.ceil(block_frames * hop_size)), 1)
+
+    buf = None
+    offset = 0
+    n_samples = 0
+    frame = 0
+
+    for block in _iter_signal_blocks(source, block_samples, downmix):
+        buf = block if buf is None else np.concatenate((buf, block), -1)
+        n_samples += block.shape[-1]
+
+        while True:
+            starts = _frame_starts(frame, frame + block_frames, hop_size)
+            if starts[-1] + window_size > n_samples:
+                break
+            yield _transform_block(buf, starts - offset, window, return_angles,
+                                   dtype, half_spectrum)
+
+            frame += block_frames
+            drop = _frame_starts(frame, frame + 1, hop_size)[0] - offset
+            buf = buf[..., drop:]
+            offset += drop
+
+    length = max((n_samples - window_size) // int(hop_size) + 1, 0)
+    while frame < length:
+        starts = _frame_starts(frame, min(frame + block_frames, length), hop_size)
+        missing = starts[-1] + window_size - offset - buf.shape[-1]
+        if missing > 0:
+            buf = np.concatenate((buf, np.zeros(buf.shape[:-1] + (missing,))), -1)
+        yield _transform_block(buf, starts - offset, window, return_angles,
+                               dtype, half_spectrum)
+        frame += len(starts)
+
+def _iter_signal_blocks(source, block_samples, downmix=None):
+    # channels first blocks, see _channels_first
+    if hasattr(source, 'signal'):
+        blocks = (source.signal[t:t + block_samples]
+                  for t in xrange(0, len(source.signal), block_samples))
+    else:
+        blocks = source
+    for block in blocks:
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        yield _channels_first(get_channels(block, downmix))
+
+def _transform_block(buf, starts, window, return_angles, dtype, half_spectrum=False):
+    frames = buf[..., starts[:, np.newaxis] + np.arange(len(window))]
+    out = _empty_spectrogram(frames.shape[:-1], len(window), return_angles, dtype, half_spectrum)
+    return _transform_frames(frames, window, return_angles, out)
+
+def _transform_frames(frames, window, return_angles, out):
+    # out's width tells full, half or magnitude spectra apart
+    window_size = len(window)
+    fft = np.fft.rfft(frames * window)
+    if not return_angles:
+        out[...] = np.abs(fft[..., :window_size // 2])
+    elif out.shape[-1] == window_size:
+        _mirror_spectrum(fft, window_size, out)
+    else:
+        out[...] = fft
+    return out
 
-    signal = a.signal[:, 0]
+def _empty_spectrogram(shape, window_size, return_angles, dtype, half_spectrum=False):
+    if return_angles:
+        width = window_size // 2 + 1 if half_spectrum else window_size
+        return np.zeros(shape + (width,), dtype=np.result_type(dtype, np.complex64))
+    return np.zeros(shape + (window_size // 2,), dtype=dtype)
+
+def _frame_starts(start, end, hop_size):
+    if hop_size == int(hop_size):
+        return np.arange(start, end) * int(hop_size)
+    # fractional hop sizes round each start to the nearest sample
+    return np.floor(np.arange(start, end) * hop_size + .5).astype(int)
+
+def _get_frames(signal, window_size, hop_size):
+    # frames along the last axis: (..., samples) -> (..., frames, window_size)
+    n_samples = signal.shape[-1]
+    length = max((n_samples - window_size) // int(hop_size) + 1, 0)
+
+    if hop_size == int(hop_size):
+        # zero-copy view, one row per frame
+        stride = signal.strides[-1]
+        return np.lib.stride_tricks.as_strided(
+            signal, shape=signal.shape[:-1] + (length, window_size),
+            strides=signal.strides[:-1] + (int(hop_size) * stride, stride))
+
+    # the last rounded frame can run off the end and gets zero padded
+    starts = _frame_starts(0, length, hop_size)
+    if length > 0 and starts[-1] + window_size > n_samples:
+        padding = np.zeros(signal.shape[:-1] + (starts[-1] + window_size - n_samples,))
+        signal = np.concatenate((signal, padding), -1)
+    return signal[..., starts[:, np.newaxis] + np.arange(window_size)]
+
+def _mirror_spectrum(half, window_size, out=None):
+    if out is None:
+        out = np.zeros(half.shape[:-1] + (window_size,), dtype=half.dtype)
+    n_half = window_size // 2 + 1
+    out[..., :n_half] = half
+    out[..., n_half:] = np.conj(half[..., 1:(window_size + 1) // 2][..., ::-1])
+    return out
+
+def get_variable_spectra(a, split_points, downmix=None, padded=False, n_bins=None):
+    # one full spectrum per segment, (channels, bins) for multi-channel audio.
+    # with padded, segments are zero padded to power of two fft sizes and
+    # transformed one size bucket at a time, returning (spectra, lengths,
+    # fft_sizes) where spectra is a (segments, max_bins) complex half
+    # spectrum array, (channels, segments, max_bins) for multi-channel audio,
+    # with fft_sizes[i] // 2 + 1 bins filled in for segment i. with n_bins,
+    # the magnitudes are instead interpolated onto n_bins bins spaced like
+    # a spectrogram with window size 2 * n_bins, for chroma.get_chromagram
+    signal = _channels_first(get_channels(a.signal, downmix))
+    split_points = np.append(split_points, signal.shape[-1]).astype(int)
+
+    if n_bins is not None:
+        spectra, lengths, fft_sizes = _get_padded_spectra(signal, split_points, n_bins)
+        return spectra
+    if padded:
+        return _get_padded_spectra(signal, split_points)
 
     spectra = []
-    split_points = np.append(split_points, len(a.signal))
     for t0, t1 in zip(split_points[:-1], split_points[1:]):
-        spectra.append(scipy.fft(signal[int(t0):int(t1)]))
+        spectra.append(np.fft.fft(signal[..., t0:t1]))
     return spectra
 
+def _get_padded_spectra(signal, split_points, n_bins=None):
+    # with n_bins, each bucket is resampled to magnitudes right after its
+    # rfft, so the array padded to the largest fft size is never built
+    starts = split_points[:-1]
+    lengths = np.diff(split_points)
+    fft_sizes = 2 ** np.ceil(np.log2(np.maximum(lengths, 1))).astype(int)
+
+    if n_bins is None:
+        spectra = np.zeros((len(lengths),) + signal.shape[:-1] + (fft_sizes.max() // 2 + 1,),
+                           dtype=np.complex128)
+    else:
+        spectra = np.zeros((len(lengths),) + signal.shape[:-1] + (n_bins,))
+    for fft_size in np.unique(fft_sizes):
+        segments = np.nonzero(fft_sizes == fft_size)[0]
+        bucket = np.zeros((len(segments),) + signal.shape[:-1] + (fft_size,))
+        for i, segment in enumerate(segments):
+            bucket[i, ..., :lengths[segment]] = signal[..., starts[segment]:split_points[segment + 1]]
+        if n_bins is None:
+            spectra[segments, ..., :fft_size // 2 + 1] = np.fft.rfft(bucket)
+        else:
+            spectra[segments] = _resample_spectrum(np.abs(np.fft.rfft(bucket)), fft_size, n_bins)
+
+    # segments first for mono, channels first otherwise like get_spectrogram
+    return np.moveaxis(spectra, 0, -2), lengths, fft_sizes
+
+def _resample_spectrum(spectra, fft_size, n_bins):
+    # linear interpolation of (..., fft_size // 2 + 1) spectra, where bin
+    # j is at j / fft_size of the sample rate, onto bins at k / (2 * n_bins)
+    positions = np.minimum(np.arange(n_bins) * (fft_size / (2.0 * n_bins)), fft_size // 2)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, fft_size // 2)
+    weights = positions - lower
+    return (1 - weights) * spectra[..., lower] + weights * spectra[..., upper]
+
 def filter_peaks(spectrogram):
     coords = argrelmax(spectrogram, order=20, axis=1)
     maxes = np.zeros(spectrogram.shape)
     maxes[coords] = spectrogram[coords]
     return maxes
 
-def median_filter(s_or_a, order=11, p=2):
-
+def median_filter(s_or_a, order=11, p=2, half_spectrum=False, block_frames=None,
+                  downmix=None):
+    # keeps the harmonic part for positive orders, the percussive part
+    # for negative orders
+    harmonic, percussive = hpss(s_or_a, abs(order), p, half_spectrum, block_frames,
+                                keep_harmonic=order > 0, keep_percussive=order < 0,
+                                downmix=downmix)
+    if order > 0:
+        return harmonic
+    else:
+        return percussive
+
+def hpss(s_or_a, order=11, p=2, half_spectrum=False, block_frames=None,
+         keep_harmonic=True, keep_percussive=True, downmix=None):
+    # harmonic/percussive separation with soft masks from median filters
+    # across time and frequency. masks are computed on the non-redundant
+    # half of the spectrum and applied in blocks of block_frames frames.
+    # (channels, frames, bins) spectrograms are separated per channel
     if hasattr(s_or_a, 'signal'):
         a = s_or_a
-        s = get_spectrogram(a, a.sample_rate / 10, a.sample_rate / 20, return_angles=True)
+        window_size = a.sample_rate / 10
+        hop_size = a.sample_rate / 20
+        s = get_spectrogram(a, window_size, hop_size, return_angles=True,
+                            half_spectrum=True, downmix=downmix)
+        half_spectrum = True
     else:
         a = None
         s = s_or_a
 
-    harmonic = medfilt2d(np.abs(s), (abs(order), 1))
-    percussive = medfilt2d(np.abs(s), (1, abs(order)))
-    if order > 0:
-        mask = harmonic ** p / (harmonic ** p + percussive ** p)
+    if s.ndim == 3:
+        parts = [_hpss_channel(channel, order, p, half_spectrum, block_frames,
+                               keep_harmonic, keep_percussive) for channel in s]
+        harmonic = np.array([h for h, _ in parts]) if keep_harmonic else None
+        percussive = np.array([x for _, x in parts]) if keep_percussive else None
     else:
-        mask = percussive ** p / (harmonic ** p + percussive ** p)
-    masked = s * mask
-    masked[np.isnan(masked)] = 0
+        harmonic, percussive = _hpss_channel(s, order, p, half_spectrum, block_frames,
+                                             keep_harmonic, keep_percussive)
 
     if a:
-        masked_audio = get_audio(masked, a.sample_rate, a.sample_rate / 10, a.sample_rate / 20)
-        return masked_audio
+        if keep_harmonic:
+            harmonic = get_audio(harmonic, a.sample_rate, window_size, hop_size)
+        if keep_percussive:
+            percussive = get_audio(percussive, a.sample_rate, window_size, hop_size)
+
+    return harmonic, percussive
+
+def _hpss_channel(s, order, p, half_spectrum, block_frames, keep_harmonic, keep_percussive):
+    if half_spectrum:
+        magnitude_bins = s.shape[1]
+        bin_indices = slice(None)
     else:
-        return masked
-    
-def get_audio(spectrogram, sample_rate, window_size, hop_size):
+        magnitude_bins = s.shape[1] // 2 + 1
+        bins = np.arange(s.shape[1])
+        bin_indices = np.minimum(bins, s.shape[1] - bins)
+
+    harmonic = np.zeros_like(s) if keep_harmonic else None
+    percussive = np.zeros_like(s) if keep_percussive else None
+
+    for block, harmonic_mask, percussive_mask in _iter_hpss_masks(
+            s[:, :magnitude_bins], order, p, block_frames):
+        if keep_harmonic:
+            harmonic[block] = s[block] * harmonic_mask[:, bin_indices]
+        if keep_percussive:
+            percussive[block] = s[block] * percussive_mask[:, bin_indices]
+
+    return harmonic, percussive
+
+def _iter_hpss_masks(s, order, p, block_frames=None):
+    length = len(s)
+    if block_frames is None:
+        block_frames = max(length, 1)
+
+    # frames of context on each side for the median across time
+    context = order // 2
+
+    for i in xrange(0, length, block_frames):
+        start = max(i - context, 0)
+        end = min(i + block_frames + context, length)
+        magnitude = np.abs(s[start:end])
+
+        harmonic = scipy.ndimage.median_filter(magnitude, size=(order, 1), mode='constant')
+        percussive = scipy.ndimage.median_filter(magnitude, size=(1, order), mode='constant')
+        inner = slice(i - start, min(i + block_frames, length) - start)
+        harmonic = harmonic[inner]
+        percussive = percussive[inner]
+
+        harmonic **= p
+        percussive **= p
+        total = harmonic + percussive
+        silent = total == 0
+        total[silent] = 1
+        harmonic /= total
+        percussive /= total
+
+        yield slice(i, i + block_frames), harmonic, percussive
+
+def get_audio(spectrogram, sample_rate, window_size, hop_size, window_function=np.hanning):
+    # inverse of get_spectrogram with return_angles, from either full or
+    # half spectra. frames are weighted by the synthesis window and
+    # overlap-added, then divided by the overlapped squared window so an
+    # unmodified spectrogram reconstructs its signal. (channels, frames, bins)
+    # spectrograms give multi-channel audio
     from andreasmusic import audio
 
-    #spectrogram = np.hstack((spectrogram, spectrogram[:, ::-1]))
+    window = window_function(window_size)
+    if spectrogram.ndim == 3:
+        signal = np.array([_get_signal(s, window, hop_size) for s in spectrogram]).T
+    else:
+        signal = _get_signal(spectrogram, window, hop_size)[:, np.newaxis]
+
+    return audio.Audio(signal.astype(np.float32), sample_rate)
+
+def _get_signal(spectrogram, window, hop_size):
+    window_size = len(window)
+    length = len(spectrogram)
+    starts = _frame_starts(0, length, hop_size)
+    n_samples = starts[-1] + window_size if length > 0 else 0
+    signal = np.zeros(n_samples)
+    norm = np.zeros(n_samples)
+
+    for i in xrange(0, length, STFT_BLOCK_FRAMES):
+        half = _half_spectrum(spectrogram[i:i + STFT_BLOCK_FRAMES], window_size)
+        block_starts = starts[i:i + STFT_BLOCK_FRAMES]
+        _overlap_add(np.fft.irfft(half, window_size) * window, block_starts, signal)
+        _overlap_add(np.tile(window ** 2, (len(half), 1)), block_starts, norm)
+
+    nonzero = norm > 1e-10 * np.max(norm) if n_samples > 0 else norm > 0
+    signal[nonzero] /= norm[nonzero]
+
+    return signal
+
+def _half_spectrum(spectrogram, window_size):
+    n_half = window_size // 2 + 1
+    if spectrogram.shape[1] == n_half:
+        return spectrogram
+    # hermitian part of a full spectrum, so that irfft gives the real
+    # part of its full inverse fft even if it is not symmetric
+    mirror = -np.arange(n_half) % window_size
+    return (spectrogram[:, :n_half] + np.conj(spectrogram[:, mirror])) / 2
+
+def _overlap_add(frames, starts, out):
+    length, window_size = frames.shape
+    if length == 0:
+        return out
+
+    hop_size = starts[1] - starts[0] if length > 1 else window_size
+    if length > 1 and np.any(np.diff(starts) != hop_size):
+        np.add.at(out, starts[:, np.newaxis] + np.arange(window_size), frames)
+        return out
+
+    # split each frame into hop_size blocks and add them to the output
+    # viewed as rows of hop_size samples, one block offset at a time
+    n_blocks = -(-window_size // hop_size)
+    padded = np.zeros((length, n_blocks * hop_size))
+    padded[:, :window_size] = frames
+    padded = padded.reshape((length, n_blocks, hop_size))
+
+    n_rows = length + n_blocks - 1
+    region = np.zeros((n_rows, hop_size))
+    for j in xrange(n_blocks):
+        region[j:j + length] += padded[:, j]
+
+    region = region.ravel()
+    end = min(starts[0] + len(region), len(out))
+    out[starts[0]:end] += region[:end - starts[0]]
+    return out
+
+# filterbank values below this fraction of their row's peak are dropped
+# from the sparse bank
+FILTERBANK_CUTOFF = 1e-10
+
+# (sample_rate, window_size, harmonics, gaussian_width, n_pitches, normalise)
+# -> sparse (n_pitches * harmonics, window_size / 2) filterbank
+_overtone_filterbanks = {}
+
+def get_overtone_filterbank(sample_rate, window_size, harmonics=16, gaussian_width=1.0/24,
+                            n_pitches=MAX_PITCH - MIN_PITCH, normalise=True):
+    key = (sample_rate, window_size, harmonics, gaussian_width, n_pitches, normalise)
+    if key in _overtone_filterbanks:
+        return _overtone_filterbanks[key]
+
+    halfwin = window_size / 2.0
 
-    window = 1 #np.hanning(window_size)
-    signal = np.zeros(len(spectrogram) * hop_size + (window_size - hop_size))
-    for i, t in enumerate(xrange(0, len(spectrogram) * hop_size, hop_size)):
-        signal[t:t + window_size] += np.real(scipy.ifft(spectrogram[i])) * window
+    pitches = np.arange(MIN_PITCH, MIN_PITCH + n_pitches)
+    freqs = apitches.C0.fq * 2 ** (pitches / 12.0)
+    indices = np.round(halfwin * freqs / (sample_rate / 2))
 
-    return audio.Audio(signal[np.newaxis].T.astype(np.float32), sample_rate)
+    # one gaussian per (pitch, harmonic), centered on the harmonic's bin
+    x = (indices[:, np.newaxis] * np.arange(1, harmonics + 1)).ravel() / halfwin
+    filterbank = np.exp(-((np.linspace(0, 1, int(halfwin)) - x[:, np.newaxis]) /
+                          (x[:, np.newaxis] * gaussian_width)) ** 2)
+    mask = filterbank > FILTERBANK_CUTOFF * np.max(filterbank, 1)[:, np.newaxis]
 
+    if normalise:
+        filterbank /= np.sum(filterbank, 1)[:, np.newaxis]
+    filterbank[~mask] = 0
 
+    filterbank = scipy.sparse.csr_matrix(filterbank)
+    _overtone_filterbanks[key] = filterbank
+    return filterbank
 
 def overtones_to_spectrogram(overtones, sample_rate, window_size, gaussian_width=1.0/24):
-    halfwin = window_size / 2.0
     length, n_pitches, n_harmonics = overtones.shape
 
-    def f(x):
-        return np.exp(-(np.linspace(-x, 1-x, halfwin) / (x * gaussian_width)) ** 2)
-
-    spectrogram = np.zeros((len(overtones), int(halfwin)))
+    filterbank = get_overtone_filterbank(sample_rate, window_size, n_harmonics,
+                                         gaussian_width, n_pitches, normalise=False)
+    flat = overtones.reshape((length, n_pitches * n_harmonics))
 
-    for i in xrange(n_pitches):
-        pitch = i + MIN_PITCH
-        freq = apitches.C0.fq * 2 ** (pitch / 12.0)
-        index = np.round(halfwin * freq / (sample_rate / 2))
-
-        filterbank = np.array([
-            f(x) for x in np.arange(index, index * (n_harmonics + 1), index) / halfwin
-        ])
-        #filterbank = (filterbank.T / np.sum(filterbank, 1)).T
-
-        spectrogram += overtones[:, i, :].dot(filterbank)
-
-    return spectrogram
+    return filterbank.T.dot(flat.T).T
 
 def spectrogram_to_overtones(spectrogram, sample_rate, window_size, harmonics=16, gaussian_width=1.0/24):
-    halfwin = window_size / 2.0
+    n_pitches = MAX_PITCH - MIN_PITCH
 
-    def f(x):
-        return np.exp(-(np.linspace(-x, 1-x, halfwin) / (x * gaussian_width)) ** 2)
+    filterbank = get_overtone_filterbank(sample_rate, window_size, harmonics,
+                                         gaussian_width, n_pitches)
+    overtones = filterbank.dot(spectrogram.T).T
 
-    pitches = range(MIN_PITCH, MAX_PITCH)
+    return overtones.reshape((len(spectrogram), n_pitches, harmonics))
 
-    overtones = np.zeros((len(spectrogram), len(pitches), harmonics))
-
-    for i, pitch in enumerate(pitches):
-        freq = apitches.C0.fq * 2 ** (pitch / 12.0)
-        index = np.round(halfwin * freq / (sample_rate / 2))
-
-        filterbank = np.array([
-            f(x) for x in np.arange(index, index * (harmonics + 1), index) / halfwin
-        ])
-        filterbank = (filterbank.T / np.sum(filterbank, 1)).T
-
-        for t, s in enumerate(spectrogram):
-            overtones[t, i, :] = np.sum(filterbank * s, 1)
-
-
-    return overtones
-
-def _get_centroid_mask(overtones):
-    flat = overtones.reshape((len(overtones) * 48, overtones.shape[2]))
+def fit_overtone_centroids(overtones, n_centroids=24, max_samples=None, seed=None):
+    # k-means centroids of the peak-normalised overtone profiles whose
+    # strongest harmonic is the fundamental. with max_samples, they are
+    # fit on a random subset of at most that many profiles. the result
+    # can be passed to _get_centroid_mask for other tracks
+    flat = overtones.reshape((-1, overtones.shape[2]))
     f0flat = flat[np.argmax(flat, 1) == 0]
     f0flat = f0flat[np.max(f0flat, 1) > 0]
     f0flat = (f0flat.T / np.max(f0flat, 1)).T
 
-    centroids, distortion = kmeans(f0flat, 24)
-    codes, dists = vq(f0flat, centroids)
-    #centroids = centroids[np.bincount(codes) > np.median(np.bincount(codes))]    
-    flat_norm = (flat.T / np.max(flat, 1)).T
-    codes, dists = vq(flat_norm, centroids)
+    state = np.random.get_state()
+    try:
+        if seed is not None:
+            np.random.seed(seed)
+        if max_samples is not None and len(f0flat) > max_samples:
+            f0flat = f0flat[np.random.choice(len(f0flat), max_samples, replace=False)]
+        centroids, distortion = kmeans(f0flat, n_centroids)
+    finally:
+        if seed is not None:
+            np.random.set_state(state)
 
-    flat_filtered = np.copy(flat)
+    return centroids
 
-    for i, (s, c) in enumerate(zip(flat, codes)):
-        if c < 0 or c > len(centroids):
-            continue
+def _get_centroid_mask(overtones, centroids=None, n_centroids=24, max_samples=None, seed=None):
+    if centroids is None:
+        centroids = fit_overtone_centroids(overtones, n_centroids, max_samples, seed)
 
-        centroid = centroids[c]
-        centroid_denorm = centroid * np.max(s)
-        flat_filtered[i, 1:] -= centroid_denorm[1:]
-        flat_filtered[i, 1:] = np.maximum(flat_filtered[i, 1:], 0)
+    flat = overtones.reshape((-1, overtones.shape[2]))
+    peaks = np.max(flat, 1)
+    nonzero = peaks > 0
+    flat = flat[nonzero]
+    peaks = peaks[nonzero]
 
-    overtones_filtered = flat_filtered.reshape(overtones.shape)
+    codes, dists = vq(flat / peaks[:, np.newaxis], centroids)
 
-    return overtones_filtered
+    # subtract each profile's nearest centroid, scaled to the profile's
+    # peak, from everything but the fundamental
+    filtered = flat[:, 1:] - centroids[codes, 1:] * peaks[:, np.newaxis]
+    np.maximum(filtered, 0, filtered)
+
+    overtones_filtered = np.copy(overtones).reshape((-1, overtones.shape[2]))
+    overtones_filtered[nonzero, 1:] = filtered
+
+    return overtones_filtered.reshape(overtones.shape)
 
 def get_filterbank(i, halfwin=2048, gaussian_width=1.0/50, harmonics=50):
     i = float(i)
 
-    def f(x):
-        return np.exp(-(np.linspace(-x, 1-x, halfwin) / (x * gaussian_width)) ** 2)
-
-    fb = np.array([
-        f(x) for x in np.arange(i, i * (harmonics + 1), i) / halfwin
-    ])
+    x = np.arange(1, harmonics + 1)[:, np.newaxis] * i / halfwin
+    fb = np.exp(-((np.linspace(0, 1, halfwin) - x) / (x * gaussian_width)) ** 2)
 
     #fb = (fb.T * np.linspace(1, 0, len(fb))).T
     fb[0, :] = 0
@@ -188,9 +518,25 @@ def get_filterbank(i, halfwin=2048, gaussian_width=1.0/50, harmonics=50):
     fb = np.min(1 - fb, 0)
     
     return fb
-    
 
-def filter_overtones_static(sg):
+# (halfwin, gaussian_width, harmonics) -> {i: (bins, 1 - get_filterbank(i)[bins])}
+_static_filterbanks = {}
+
+def _get_static_filterbanks(halfwin, gaussian_width=1.0/50, harmonics=50):
+    key = (halfwin, gaussian_width, harmonics)
+    if key not in _static_filterbanks:
+        filterbanks = {}
+        for i in xrange(1, halfwin / 4):
+            attenuation = 1 - get_filterbank(i, halfwin, gaussian_width, harmonics)
+            # bins that are attenuated by a negligible amount are skipped
+            bins = np.nonzero(attenuation > FILTERBANK_CUTOFF)[0]
+            filterbanks[i] = bins, attenuation[bins]
+        _static_filterbanks[key] = filterbanks
+    return _static_filterbanks[key]
+
+def filter_overtones_static(sg, progress=None):
+    # progress, if given, is called with the current fundamental bin
+    # every 100 bins
 
     filtered = np.copy(sg)
 
@@ -198,13 +544,14 @@ def filter_overtones_static(sg):
 
     mx = np.max(sg)
 
+    filterbanks = _get_static_filterbanks(halfwin)
+
     for i in xrange(halfwin / 4 - 1, 0, -1):
-        fb = get_filterbank(i, halfwin)
-        if i % 100 == 0:
-            print i
-        for t, s in enumerate(filtered):
-            fb1 = (1 - (1 - fb) * (min(s[i] * 5 / mx, 1)))
-            filtered[t] *= fb1
+        bins, attenuation = filterbanks[i]
+        if progress is not None and i % 100 == 0:
+            progress(i)
+        strength = np.minimum(filtered[:, i] * 5 / mx, 1)
+        filtered[:, bins] *= 1 - np.outer(strength, attenuation)
 
     return filtered
 
@@ -1,10 +1,17 @@
 import multiprocessing
+import threading
+import traceback
+import collections
 import cPickle
 import tempfile
 import simplejson as json
 import os
 from contextlib import contextmanager
 import hashlib
+import functools
+import sys
+import types
+import numpy as np
 
 @contextmanager
 def temporary_filename(suffix=''):
@@ -20,9 +27,134 @@ def get_temporary_filename(suffix=''):
     os.close(f)
     return filename
 
+@contextmanager
+def atomic_write(filename):
+    # writes to a temporary file next to filename and renames it into
+    # place, so readers never see a partially written file
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+
 def lazy_parallel(obj, inputs, n_workers):
     pool = multiprocessing.Pool(processes=n_workers)
-    return pool.imap(obj, inputs)
+    try:
+        for result in pool.imap(obj, inputs):
+            yield result
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+BatchResult = collections.namedtuple('BatchResult', ['input', 'value', 'error'])
+
+class Pipeline(object):
+    # chains picklable stages, e.g.
+    # Pipeline(audio.read, functools.partial(spectrum.get_spectrogram,
+    #                                        window_size=4096, hop_size=2048))
+
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def __call__(self, x):
+        for stage in self.stages:
+            x = stage(x)
+        return x
+
+class _CaptureErrors(object):
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, x):
+        try:
+            return BatchResult(x, self.fn(x), None)
+        except Exception:
+            return BatchResult(x, None, traceback.format_exc())
+
+def parallel_batch(fn, inputs, n_workers=None, chunksize=1,
+                   max_in_flight=None, ordered=False):
+    # yields a BatchResult per input, with the formatted traceback in
+    # error if fn raised. at most max_in_flight inputs are queued or
+    # computed but not yet consumed, which bounds memory when the
+    # results are large
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers * chunksize
+    max_in_flight = max(max_in_flight, chunksize)
+
+    slots = threading.Semaphore(max_in_flight)
+    stopped = []
+
+    def throttled_inputs():
+        for x in inputs:
+            slots.acquire()
+            if stopped:
+                return
+            yield x
+
+    pool = multiprocessing.Pool(processes=n_workers)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(_CaptureErrors(fn), throttled_inputs(), chunksize):
+            slots.release()
+            yield result
+        pool.close()
+        pool.join()
+    finally:
+        # unblock the pool's task feeder if we stopped early
+        stopped.append(True)
+        slots.release()
+        pool.terminate()
+
+def run_batch(fn, inputs, sink, **kwargs):
+    # passes each successful value to sink(input, value) and returns
+    # the failed results
+    failures = []
+    for result in parallel_batch(fn, inputs, **kwargs):
+        if result.error is None:
+            sink(result.input, result.value)
+        else:
+            failures.append(result)
+    return failures
+
+class NpySink(object):
+    # saves each value as a .npy named after the input path. with root,
+    # the path relative to root is mirrored under directory, otherwise
+    # (and for inputs outside root) a hash of the absolute path tells
+    # apart inputs with the same name
+
+    def __init__(self, directory, root=None):
+        self.directory = os.path.expanduser(directory)
+        self.root = None if root is None else os.path.abspath(os.path.expanduser(root))
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, x):
+        if self.root is not None:
+            relative = os.path.relpath(os.path.abspath(x), self.root)
+            if relative.split(os.sep)[0] != os.pardir:
+                name, _ = os.path.splitext(relative)
+                return os.path.join(self.directory, name + '.npy')
+        # inputs outside root are named like without a root
+        name, _ = os.path.splitext(os.path.basename(x))
+        name += '-' + hashlib.sha1(os.path.abspath(x)).hexdigest()[:12]
+        return os.path.join(self.directory, name + '.npy')
+
+    def __call__(self, x, value):
+        path = self.path(x)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with atomic_write(path) as f:
+            np.save(f, value)
 
 class Cached(object):
 
@@ -37,7 +169,7 @@ class Cached(object):
                 result = cPickle.load(f)
         else:
             result = self.run(x)
-            with open(cache_path, 'w') as f:
+            with atomic_write(cache_path) as f:
                 cPickle.dump(result, f, protocol=cPickle.HIGHEST_PROTOCOL)
         return result
 
@@ -73,7 +205,7 @@ def cached(filename, fmt='json'):
 
             ret = fn(*args, **kwargs)
 
-            with open(fname, 'w') as f:
+            with atomic_write(fname) as f:
                 if fmt == 'json':
                     json.dump(ret, f)
                 elif fmt == 'pickle':
@@ -84,3 +216,176 @@ def cached(filename, fmt='json'):
         return wrapper
 
     return decorator
+
+
+# fraction of max_bytes that FeatureCache evicts down to
+EVICT_LOW_WATER = 0.9
+
+class FeatureCache(object):
+    # caches fn(filename, *args, **kwargs) under a key made from the
+    # contents of filename, the identity of fn and the parameters.
+    # arrays are stored as .npy and memory-mapped on load, everything
+    # else is pickled. when max_bytes is set, a running estimate of the
+    # cache size is kept, and once a write takes it past max_bytes the
+    # least recently used entries are evicted down to EVICT_LOW_WATER of
+    # max_bytes. the estimate only counts this process's writes between
+    # walks, so with several workers the cache can overshoot until one
+    # of them walks
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self._file_hashes = {}
+        self._estimated_bytes = None
+
+    def __call__(self, fn, filename, *args, **kwargs):
+        return self._call(fn, fn, filename, args, kwargs)
+
+    def _call(self, fn, key, filename, args, kwargs):
+        path = self.path(key, filename, args, kwargs)
+
+        for extension in ('.npy', '.pickle'):
+            try:
+                value = self._load(path + extension)
+            except (IOError, OSError):
+                continue
+            _touch(path + extension)
+            return value
+
+        value = fn(filename, *args, **kwargs)
+        size = self._store(path, value)
+        if self.max_bytes is not None:
+            if self._estimated_bytes is None:
+                self._estimated_bytes = sum(size for _, size, _ in self.entries())
+            else:
+                self._estimated_bytes += size
+            if self._estimated_bytes > self.max_bytes:
+                self.evict(int(self.max_bytes * EVICT_LOW_WATER))
+        return value
+
+    def cached(self, fn, key=None):
+        # key stands in for fn in the cache key, for callables without a
+        # stable identity, or to invalidate entries when fn changes
+        return _FeatureCached(self, fn, fn if key is None else key)
+
+    def path(self, fn, filename, args, kwargs):
+        m = hashlib.sha1()
+        m.update(self.file_hash(filename))
+        m.update(json.dumps([fn, args, sorted(kwargs.items())], default=_identity,
+                            sort_keys=True))
+        key = m.hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def file_hash(self, filename):
+        stat = os.stat(filename)
+        memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if memo_key not in self._file_hashes:
+            m = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    m.update(chunk)
+            self._file_hashes[memo_key] = m.hexdigest()
+        return self._file_hashes[memo_key]
+
+    def entries(self):
+        # (mtime, size, path) of every cache file, oldest first
+        entries = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # another worker got there first
+                pass
+            total -= size
+        self._estimated_bytes = total
+
+    def _load(self, path):
+        if path.endswith('.npy'):
+            return np.load(path, mmap_mode='r')
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+
+    def _store(self, path, value):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        # returns the number of bytes written
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            with atomic_write(path + '.npy') as f:
+                np.save(f, value)
+                return f.tell()
+        else:
+            with atomic_write(path + '.pickle') as f:
+                cPickle.dump(value, f, protocol=cPickle.HIGHEST_PROTOCOL)
+                return f.tell()
+
+class _FeatureCached(object):
+
+    def __init__(self, cache, fn, key):
+        self.cache = cache
+        self.fn = fn
+        self.key = key
+
+    def __call__(self, filename, *args, **kwargs):
+        return self.cache._call(self.fn, self.key, filename, args, kwargs)
+
+def _identity(obj):
+    # json encodable identity of obj that is the same across processes
+    # and runs. functions and classes are named by module, methods by
+    # their instance and name, other objects (such as a Pipeline and its
+    # stages) by their class and state
+    if isinstance(obj, functools.partial):
+        return [obj.func, obj.args, sorted((obj.keywords or {}).items())]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ufunc):
+        return 'numpy.%s' % obj.__name__
+    if isinstance(obj, types.ModuleType):
+        return obj.__name__
+    if hasattr(obj, '__name__'):
+        owner = getattr(obj, '__self__', None)
+        if owner is None:
+            # unbound method
+            owner = getattr(obj, 'im_class', None)
+        if owner is not None and not isinstance(owner, types.ModuleType):
+            return [owner, obj.__name__]
+        module = sys.modules.get(getattr(obj, '__module__', None))
+        if getattr(module, obj.__name__, None) is obj:
+            return '%s.%s' % (module.__name__, obj.__name__)
+    elif hasattr(obj, '__dict__'):
+        return [obj.__class__, obj.__dict__]
+    # lambdas, nested functions and the like would otherwise collide or
+    # never hit
+    raise TypeError('%r has no stable cache identity, pass a key' % (obj,))
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
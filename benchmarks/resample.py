@@ -0,0 +1,34 @@
+# compares Audio.downsample and Audio.resample on throughput and on
+# how much of a tone above the target nyquist frequency aliases back
+#
+#     python benchmarks/resample.py
+
+import time
+import numpy as np
+
+from andreasmusic import audio
+
+def alias_level(a):
+    # spectral peak in dB relative to a full scale tone
+    spectrum = np.abs(np.fft.rfft(a.signal[:, 0] * np.hanning(len(a.signal))))
+    return 20 * np.log10(np.max(spectrum) / (np.sum(np.hanning(len(a.signal))) / 2))
+
+def main():
+    sample_rate = 44100
+    seconds = 60
+    t = np.arange(sample_rate * seconds) / float(sample_rate)
+    # 15 kHz is above the 11025 Hz nyquist of the target rate
+    tone = audio.Audio(np.sin(2 * np.pi * 15000 * t)[:, np.newaxis].astype('float32'),
+                       sample_rate)
+
+    for name, fn in [('downsample(2)', lambda a: a.downsample(2)),
+                     ('resample(22050)', lambda a: a.resample(22050)),
+                     ('resample(16000)', lambda a: a.resample(16000))]:
+        start = time.time()
+        resampled = fn(tone)
+        elapsed = time.time() - start
+        print '%-16s %6.1fx realtime  alias level %6.1f dB' % (
+            name, seconds / elapsed, alias_level(resampled.crop(0, sample_rate)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# minimal stand-in for ffmpeg, used by the tests when ffmpeg is not
+# installed. decodes 16 bit pcm wav files to a float32 wav stream on
+# stdout, and encodes raw f32le on stdin to a 16 bit pcm wav file.
+
+import sys
+import struct
+import wave
+from array import array
+
+def main(args):
+    options = {}
+    output = args[-1]
+    i = 0
+    while i < len(args) - 1:
+        if args[i] in ('-y', '-vn'):
+            i += 1
+        else:
+            options[args[i]] = args[i + 1]
+            i += 2
+
+    if options['-i'] == 'pipe:0':
+        encode(options, output)
+    else:
+        decode(options)
+
+def decode(options):
+    f = wave.open(options['-i'], 'rb')
+    if f.getsampwidth() != 2:
+        sys.stderr.write('fake_ffmpeg only reads 16 bit wav files\n')
+        sys.exit(1)
+    sample_rate = f.getframerate()
+    channels = f.getnchannels()
+    samples = array('h')
+    from_bytes(samples, f.readframes(f.getnframes()))
+    frames = [[samples[t + c] / 32768.0 for c in range(channels)]
+              for t in range(0, len(samples), channels)]
+
+    start = int(float(options.get('-ss', 0)) * sample_rate)
+    frames = frames[start:]
+    if '-t' in options:
+        frames = frames[:int(float(options['-t']) * sample_rate)]
+    if '-ac' in options:
+        out_channels = int(options['-ac'])
+        frames = [[sum(frame) / len(frame)] * out_channels for frame in frames]
+        channels = out_channels
+    if '-ar' in options:
+        out_rate = int(options['-ar'])
+        n = int(len(frames) * out_rate / sample_rate)
+        frames = [frames[t * sample_rate // out_rate] for t in range(n)]
+        sample_rate = out_rate
+
+    data = to_bytes(array('f', [x for frame in frames for x in frame]))
+    fmt = struct.pack('<HHIIHH', 3, channels, sample_rate,
+                      sample_rate * channels * 4, channels * 4, 32)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(b'RIFF' + struct.pack('<I', 0xffffffff) + b'WAVE')
+    out.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+    out.write(b'data' + struct.pack('<I', 0xffffffff) + data)
+
+def encode(options, output):
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    samples = array('f')
+    from_bytes(samples, stdin.read())
+    pcm = array('h', [int(max(min(x, 1), -1) * 32767) for x in samples])
+    f = wave.open(output, 'wb')
+    f.setnchannels(int(options['-ac']))
+    f.setsampwidth(2)
+    f.setframerate(int(options['-ar']))
+    f.writeframes(to_bytes(pcm))
+    f.close()
+
+def from_bytes(a, data):
+    getattr(a, 'frombytes', getattr(a, 'fromstring', None))(data)
+
+def to_bytes(a):
+    return getattr(a, 'tobytes', getattr(a, 'tostring', None))()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
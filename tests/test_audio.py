@@ -1,7 +1,13 @@
 import os
 import unittest2 as unittest
+import numpy as np
+import struct
+import scipy.signal
+import scipy.io.wavfile
+from distutils.spawn import find_executable
 
 from andreasmusic import audio
+from andreasmusic import util
 
 from util import rel_path
 
@@ -39,3 +45,273 @@ class TestRead(unittest.TestCase):
         self.assertLess(a.signal.shape[0], 47000)
         self.assertEquals(a.sample_rate, 44100)
 
+
+    def test_read_lazy_wav(self):
+        filename = rel_path('data/audio/rate44100-bits16-channels2-freq440-duration1.wav')
+        eager = audio.read(filename)
+        lazy = audio.read(filename, lazy=True)
+        self.assertIsInstance(lazy.signal, audio.LazySignal)
+        self.assertEquals(lazy.signal.shape, eager.signal.shape)
+        self.assertTrue(np.array_equal(np.asarray(lazy.signal), eager.signal))
+
+        cropped = lazy.crop(1000, 2000)
+        self.assertEquals(cropped.signal.dtype, np.float32)
+        self.assertTrue(np.array_equal(cropped.signal, eager.signal[1000:2000]))
+
+        channel = lazy.get_channel(1)
+        self.assertIsInstance(channel.signal, audio.LazySignal)
+        self.assertTrue(np.array_equal(channel.signal[10:20],
+                                       eager.signal[10:20, 1][:, np.newaxis]))
+
+class TestFFmpeg(unittest.TestCase):
+
+    def setUp(self):
+        self.ffmpeg = audio.FFMPEG
+        if find_executable('ffmpeg') is None:
+            audio.FFMPEG = rel_path('fake_ffmpeg.py')
+
+    def tearDown(self):
+        audio.FFMPEG = self.ffmpeg
+
+    def test_read_range(self):
+        filename = rel_path('data/audio/rate44100-bits16-channels2-freq440-duration1.wav')
+        full = audio.read(filename)
+        a = audio.read(filename, start=0.25, duration=0.5, channels=1)
+        self.assertEquals(a.sample_rate, 44100)
+        self.assertEquals(a.signal.shape, (22050, 1))
+        self.assertEquals(a.signal.dtype, np.float32)
+        self.assertTrue(np.allclose(a.signal, full.signal[11025:33075, :1], atol=1e-3))
+
+    def test_read_sample_rate(self):
+        filename = rel_path('data/audio/rate44100-bits16-channels1-freq440-duration1.wav')
+        a = audio.read(filename, sample_rate=22050)
+        self.assertEquals(a.sample_rate, 22050)
+        self.assertGreater(a.signal.shape[0], 21000)
+        self.assertLess(a.signal.shape[0], 23500)
+
+    def test_read_blocks(self):
+        filename = rel_path('data/audio/rate44100-bits16-channels2-freq440-duration1.wav')
+        a = audio.read(filename, start=0)
+        blocks = list(audio.read_blocks(filename, 10000))
+        self.assertTrue(all(len(b) <= 10000 for b in blocks))
+        self.assertTrue(np.array_equal(np.vstack(blocks), a.signal))
+
+    def test_write_mp3(self):
+        filename = rel_path('data/audio/rate44100-bits16-channels2-freq440-duration1.wav')
+        a = audio.read(filename)
+        with util.temporary_filename('.mp3') as mp3_filename:
+            a.write(mp3_filename)
+            b = audio.read(mp3_filename)
+        self.assertEquals(b.sample_rate, 44100)
+        self.assertEquals(b.signal.shape[1], 2)
+        self.assertGreater(b.signal.shape[0], 42000)
+        self.assertLess(b.signal.shape[0], 47000)
+
+class TestResample(unittest.TestCase):
+
+    def test_matches_resample_poly(self):
+        np.random.seed(0)
+        signal = np.random.randn(30001, 2)
+        for sample_rate, up, down in [(22050, 1, 2), (48000, 160, 147), (88200, 2, 1)]:
+            a = audio.Audio(signal, 44100).resample(sample_rate)
+            self.assertEquals(a.sample_rate, sample_rate)
+            self.assertEquals(a.signal.dtype, np.float32)
+            expected = scipy.signal.resample_poly(signal, up, down, axis=0)
+            self.assertEquals(a.signal.shape, expected.shape)
+            self.assertTrue(np.allclose(a.signal, expected, atol=1e-5))
+
+    def test_large_ratio_blocks(self):
+        # 2001 taps, split into blocks of 7 output samples
+        np.random.seed(0)
+        signal = np.random.randn(20000, 2)
+        block_values = audio.RESAMPLE_BLOCK_VALUES
+        audio.RESAMPLE_BLOCK_VALUES = 2001 * 2 * 7
+        try:
+            a = audio.Audio(signal, 44100).resample(441)
+        finally:
+            audio.RESAMPLE_BLOCK_VALUES = block_values
+        expected = scipy.signal.resample_poly(signal, 1, 100, axis=0)
+        self.assertEquals(a.signal.shape, expected.shape)
+        self.assertTrue(np.allclose(a.signal, expected, atol=1e-5))
+
+    def test_suppresses_aliasing(self):
+        t = np.arange(44100) / 44100.0
+        a = audio.Audio(np.sin(2 * np.pi * 15000 * t)[:, np.newaxis], 44100)
+        self.assertGreater(np.max(np.abs(a.downsample(2).signal[1000:-1000])), .5)
+        self.assertLess(np.max(np.abs(a.resample(22050).signal[1000:-1000])), .01)
+
+class TestTransforms(unittest.TestCase):
+
+    def test_copy(self):
+        a = audio.Audio(np.zeros((10, 1), dtype=np.float32), 44100)
+        b = a.copy()
+        b.signal[0] = 1
+        self.assertEquals(a.signal[0, 0], 0)
+
+    def test_crop_view(self):
+        a = audio.Audio(np.arange(10, dtype=np.float32)[:, np.newaxis], 44100)
+        cropped = a.crop(2, 5)
+        self.assertTrue(np.may_share_memory(cropped.signal, a.signal))
+        self.assertTrue(np.array_equal(cropped.signal[:, 0], [2, 3, 4]))
+
+    def test_add_at(self):
+        a = audio.Audio(np.ones((4, 1), dtype=np.float32), 44100)
+        b = audio.Audio(np.ones((3, 1), dtype=np.float32) * 2, 44100)
+        mixed = a.add_at(b, 2)
+        self.assertEquals(mixed.signal.dtype, np.float32)
+        self.assertTrue(np.array_equal(mixed.signal[:, 0], [1, 1, 3, 3, 2]))
+        self.assertTrue(np.array_equal(a.signal[:, 0], [1, 1, 1, 1]))
+
+    def test_add_at_inplace(self):
+        mix = audio.Audio(np.zeros((0, 2), dtype=np.float32), 44100)
+        clip = audio.Audio(np.ones((100, 2), dtype=np.float32), 44100)
+        for i in range(50):
+            self.assertIs(mix.add_at(clip, i * 50, inplace=True), mix)
+        self.assertEquals(mix.signal.shape, (49 * 50 + 100, 2))
+        self.assertTrue(np.all(mix.signal[50:-50] == 2))
+        self.assertTrue(np.all(mix.signal[:50] == 1))
+        self.assertTrue(np.all(mix.signal[-50:] == 1))
+
+    def test_normalise_and_clip_inplace(self):
+        signal = np.array([[-2], [1], [.5]], dtype=np.float32)
+        a = audio.Audio(signal, 44100)
+        self.assertTrue(np.allclose(a.clip(.8).signal[:, 0], [-.8, .8, .5]))
+        self.assertIs(a.normalise(inplace=True), a)
+        self.assertIs(a.signal, signal)
+        self.assertTrue(np.array_equal(signal[:, 0], [-1, .5, .25]))
+
+        out = np.zeros_like(signal)
+        self.assertIs(a.normalise(.5, out=out).signal, out)
+        self.assertTrue(np.array_equal(out[:, 0], [-.5, .25, .125]))
+
+class TestMixer(unittest.TestCase):
+
+    def test_render(self):
+        np.random.seed(0)
+        clips = [audio.Audio(np.random.randn(n, 2).astype(np.float32), 44100)
+                 for n in (1000, 500, 3000)]
+        placements = [(0, 0, 1.0), (1, 700, .5), (2, 2500, 2.0), (0, 6000, 1.0)]
+
+        mixer = audio.Mixer(44100, channels=2)
+        expected = audio.Audio(np.zeros((0, 2), dtype=np.float32), 44100)
+        for clip_x, offset, gain in placements:
+            clip = clips[clip_x]
+            mixer.add(clip, offset, gain)
+            expected = expected.add_at(audio.Audio(clip.signal * gain, 44100), offset)
+
+        self.assertEquals(len(mixer), 7000)
+        rendered = mixer.render()
+        self.assertTrue(np.allclose(rendered.signal, expected.signal))
+
+        blocks = list(mixer.iter_blocks(999))
+        self.assertTrue(all(len(b) <= 999 for b in blocks))
+        self.assertTrue(np.allclose(np.vstack(blocks), expected.signal))
+
+    def test_zero_crossing(self):
+        t = np.arange(1000)
+        clip = audio.Audio(np.sin(t * 2 * np.pi / 100.0)[:, np.newaxis], 44100)
+        mixer = audio.Mixer(44100)
+        mixer.add(clip, 10, start=30, end=420, zero_crossing=True)
+        expected = clip.crop(30, 420, zero_crossing=True)
+        self.assertEquals(len(mixer), 10 + len(expected.signal))
+        self.assertTrue(np.allclose(mixer.render().signal[10:], expected.signal))
+
+    def test_out_of_range_cut_points(self):
+        clip = audio.Audio(np.ones((100, 1)), 44100)
+        mixer = audio.Mixer(44100)
+        mixer.add(clip, 0, end=500)
+        mixer.add(clip, 50, start=-20)
+        self.assertEquals(len(mixer), 150)
+        expected = np.ones((150, 1))
+        expected[50:100] = 2
+        self.assertTrue(np.array_equal(mixer.render().signal, expected))
+        self.assertTrue(np.array_equal(np.vstack(list(mixer.iter_blocks(64))), expected))
+        with self.assertRaises(audio.AudioException):
+            mixer.add(clip, 0, start=60, end=40)
+
+class TestZeroCrossing(unittest.TestCase):
+
+    def test_find_zero_crossings(self):
+        np.random.seed(0)
+        signal = np.random.randn(5000, 1) * np.sin(np.arange(5000) / 300.0)[:, np.newaxis]
+        signal[2000:3000] = .5
+        a = audio.Audio(signal, 44100)
+
+        def reference(t, max_t):
+            for i in xrange(max_t):
+                cur = signal[t + i, 0]
+                prev = signal[t + i - 1, 0]
+                if np.sign(cur) != np.sign(prev):
+                    return t + i - 1 if np.abs(prev) < np.abs(cur) else t + i
+            return t
+
+        ts = list(np.random.randint(1, 3900, 100)) + [2000, 2500]
+        for max_t in [1, 10, 1000]:
+            expected = [reference(t, max_t) for t in ts]
+            self.assertEquals(list(a.find_zero_crossings(ts, max_t)), expected)
+            self.assertEquals([a.find_zero_crossing(t, max_t) for t in ts], expected)
+
+    def test_stereo(self):
+        signal = np.array([[1, 1], [1, -3], [-1, -3], [-1, 1]], dtype=np.float32)
+        a = audio.Audio(signal, 44100)
+        self.assertEquals(a.find_zero_crossing(1, 3), 1)
+        self.assertEquals(a.find_zero_crossing(1, 3, channel=0), 2)
+        self.assertEquals(a.find_zero_crossing(1, 3, channel=1), 0)
+        self.assertEquals(a.find_zero_crossing(3, 10), 3)
+
+class TestWavWriter(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.signal = (np.random.rand(1001, 2) * 2 - 1).astype(np.float32)
+        self.a = audio.Audio(self.signal, 22050)
+
+    def test_float32(self):
+        with util.temporary_filename('.wav') as filename:
+            self.a.write(filename)
+            sample_rate, signal = scipy.io.wavfile.read(filename)
+        self.assertEquals(sample_rate, 22050)
+        self.assertTrue(np.array_equal(signal, self.signal))
+
+    def test_int16(self):
+        for dither, tolerance in [(False, .5), (True, 1.5)]:
+            with util.temporary_filename('.wav') as filename:
+                self.a.write(filename, sample_format='int16', dither=dither)
+                b = audio.read(filename)
+            self.assertEquals(b.signal.shape, self.signal.shape)
+            self.assertLessEqual(np.max(np.abs(b.signal - self.signal)) * 2**15, tolerance)
+
+    def test_size_limit(self):
+        with util.temporary_filename('.wav') as filename:
+            writer = audio.WavWriter(filename, 22050, 2, sample_format='int16')
+            writer.max_data_size = 4 * 1000
+            writer.write(self.signal[:1000])
+            with self.assertRaises(audio.AudioException):
+                writer.write(self.signal[1000:])
+            writer.close()
+            self.assertTrue(writer.f.closed)
+            sample_rate, signal = scipy.io.wavfile.read(filename)
+        self.assertEquals(signal.shape, (1000, 2))
+
+    def test_int24_blocks(self):
+        blocks = (self.signal[t:t + 100, :1] for t in xrange(0, len(self.signal), 100))
+        with util.temporary_filename('.wav') as filename:
+            audio.write_wav_blocks(filename, blocks, 22050, sample_format='int24')
+            with open(filename, 'rb') as f:
+                data = f.read()
+        self.assertEquals(data[:4], b'RIFF')
+        self.assertEquals(struct.unpack('<I', data[4:8])[0], len(data) - 8)
+        data_size = struct.unpack('<I', data[40:44])[0]
+        self.assertEquals(data_size, 1001 * 3)
+        samples = np.frombuffer(data[44:44 + data_size], dtype=np.uint8).reshape((-1, 3))
+        samples = (samples.astype(np.int32) << np.array([8, 16, 24])).sum(1).astype(np.int32) >> 8
+        self.assertLessEqual(np.max(np.abs(samples / 2.0**23 - self.signal[:, 0])), 2**-23)
+
+    def test_mixer_write(self):
+        mixer = audio.Mixer(22050, channels=2)
+        mixer.add(self.a, 0)
+        mixer.add(self.a, 500, gain=.5)
+        with util.temporary_filename('.wav') as filename:
+            mixer.write(filename)
+            _, signal = scipy.io.wavfile.read(filename)
+        self.assertTrue(np.array_equal(signal, mixer.render().signal))
@@ -78,3 +78,14 @@ class TestChroma(unittest.TestCase):
         c = chroma.get_chromagram(s, a.sample_rate)
         for i in xrange(c.shape[1]):
             self.assertEquals(np.argmax(c[:, i]), 9)
+
+    def test_chroma_matrix_matches_bincount(self):
+        np.random.seed(0)
+        spectrogram = np.random.rand(20, 1000)
+        indices = chroma._get_chroma_indices(2000, 11025, 12, pitches.C4.fq)
+        chromagram = chroma.get_chromagram(spectrogram, 11025)
+        self.assertEquals(chromagram.shape, (20, 12))
+        for frame, s in zip(chromagram, spectrogram):
+            self.assertTrue(np.allclose(frame, np.bincount(indices, weights=s)))
+        self.assertIs(chroma.get_chroma_matrix(2000, 11025),
+                      chroma.get_chroma_matrix(2000, 11025))
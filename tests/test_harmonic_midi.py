@@ -0,0 +1,191 @@
+import os
+import shutil
+import time
+import tempfile
+import unittest2 as unittest
+import numpy as np
+import midi
+
+from andreasmusic import harmonic_midi
+
+class TestHarmonicMidi(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_track(self, events, resolution=24):
+        pattern = midi.Pattern(resolution=resolution)
+        track = midi.Track(events)
+        track.append(midi.EndOfTrackEvent(tick=0))
+        pattern.append(track)
+        filename = os.path.join(self.directory, 'test.mid')
+        midi.write_midifile(filename, pattern)
+        return filename
+
+    def test_scan(self):
+        filename = self.write_track([
+            midi.ProgramChangeEvent(tick=0, channel=1, data=[41]),
+            midi.NoteOnEvent(tick=0, channel=1, pitch=60, velocity=100),
+            midi.NoteOnEvent(tick=24, channel=1, pitch=60, velocity=100),
+            midi.NoteOnEvent(tick=0, channel=9, pitch=36, velocity=100),
+            midi.NoteOnEvent(tick=24, channel=1, pitch=60, velocity=0),
+            midi.NoteOffEvent(tick=0, channel=9, pitch=36),
+            midi.NoteOnEvent(tick=0, channel=0, pitch=64, velocity=100),
+        ])
+        scanned = harmonic_midi.scan(midi.read_midifile(filename))
+        self.assertEquals(scanned.max_tick, 48)
+        self.assertEquals(scanned.notes.tolist(), [
+            (60, 0, 48, 100, 1, 41),
+            (64, 48, 49, 100, 0, -1),
+        ])
+
+        raw = midi.read_midifile(filename)
+        raw.make_ticks_abs()
+        self.assertEquals(harmonic_midi.scan(raw).notes.tolist(),
+                          scanned.notes.tolist())
+
+    def test_read_fills_held_notes(self):
+        filename = self.write_track([
+            midi.SetTempoEvent(tick=0, bpm=90),
+            midi.NoteOnEvent(tick=0, pitch=60, velocity=100),
+            midi.NoteOnEvent(tick=24, pitch=64, velocity=100),
+            midi.NoteOffEvent(tick=72, pitch=60),
+            midi.NoteOffEvent(tick=12, pitch=64),
+            midi.NoteOnEvent(tick=12, pitch=67, velocity=100),
+        ])
+        pitches, tempos = harmonic_midi.read(filename)
+        self.assertEquals(len(tempos), 1)
+        self.assertAlmostEquals(tempos[0][1], 90, 3)
+        expected = np.zeros((6, harmonic_midi.RANGE), dtype=np.float32)
+        expected[0:4, 60 - harmonic_midi.MIN_PITCH] = 1
+        expected[1:5, 64 - harmonic_midi.MIN_PITCH] = 1
+        expected[5, 67 - harmonic_midi.MIN_PITCH] = 1
+        np.testing.assert_array_equal(pitches, expected)
+
+    def test_lower_resolution(self):
+        pitchgram = np.arange(7 * 3).reshape((7, 3))
+        lowered = harmonic_midi.lower_resolution(pitchgram, 3)
+        np.testing.assert_array_equal(lowered, [
+            pitchgram[0:3].sum(0), pitchgram[3:6].sum(0), pitchgram[6:].sum(0)])
+
+    def test_pitch_to_int(self):
+        self.assertEquals(harmonic_midi.pitch_to_int(np.array([1, 0, 1, 1])), 11)
+        p = np.zeros(harmonic_midi.RANGE)
+        p[0] = 1
+        self.assertEquals(harmonic_midi.pitch_to_int(p), 2 ** (harmonic_midi.RANGE - 1))
+        self.assertEquals(harmonic_midi.pitch_to_int(np.zeros((2, 70))), [0, 0])
+
+    def test_count_chords(self):
+        pitchgram = np.array([[1, 0, 1], [0, 0, 0], [1, 0, 1], [0, 1, 0], [1, 0, 1]])
+        chords, counts = harmonic_midi.count_chords(pitchgram)
+        self.assertEquals(sorted(zip(map(tuple, chords.astype(int)), counts)),
+                          [((0, 0, 0), 1), ((0, 1, 0), 1), ((1, 0, 1), 3)])
+
+    def test_write_note_table(self):
+        self.write_track([
+            midi.NoteOnEvent(tick=0, pitch=60, velocity=90),
+            midi.NoteOffEvent(tick=24, pitch=60),
+        ])
+        os.rename(os.path.join(self.directory, 'test.mid'),
+                  os.path.join(self.directory, 'a.mid'))
+        self.write_track([
+            midi.NoteOnEvent(tick=0, pitch=62, velocity=80),
+            midi.NoteOnEvent(tick=0, pitch=65, velocity=80),
+        ], resolution=48)
+        with open(os.path.join(self.directory, 'broken.mid'), 'w') as f:
+            f.write('not midi')
+
+        filename = os.path.join(self.directory, 'notes.npz')
+        failures = harmonic_midi.write_note_table(self.directory, filename, n_workers=2)
+        self.assertEquals([os.path.basename(f.input) for f in failures], ['broken.mid'])
+
+        table = np.load(filename)
+        self.assertEquals([os.path.basename(f) for f in table['filenames']],
+                          ['a.mid', 'test.mid'])
+        self.assertEquals(table['resolutions'].tolist(), [24, 48])
+        self.assertEquals(table['file_id'].tolist(), [0, 1, 1])
+        self.assertEquals(table['pitch'].tolist(), [60, 62, 65])
+        self.assertEquals(table['end'].tolist(), [24, 1, 1])
+        self.assertEquals(table['velocity'].tolist(), [90, 80, 80])
+
+    def test_ticks_to_seconds(self):
+        tempos = np.array([(48, 60), (0, 240), (0, 120)], dtype=harmonic_midi.TEMPO_DTYPE)
+        tempo_map = harmonic_midi.get_tempo_map(tempos, 24)
+        np.testing.assert_allclose(
+            harmonic_midi.ticks_to_seconds(np.array([0, 24, 48, 60, 72]), tempo_map),
+            [0, .5, 1, 1.5, 2])
+        tempo_map = harmonic_midi.get_tempo_map(tempos[:0], 24)
+        self.assertAlmostEquals(harmonic_midi.ticks_to_seconds(48, tempo_map), 1)
+
+    def test_read_seconds(self):
+        filename = self.write_track([
+            midi.NoteOnEvent(tick=0, pitch=60, velocity=100),
+            midi.SetTempoEvent(tick=24, bpm=60),
+            midi.NoteOffEvent(tick=24, pitch=60),
+            midi.NoteOnEvent(tick=0, pitch=64, velocity=100),
+            midi.NoteOffEvent(tick=24, pitch=64),
+        ])
+        pitches, tempos = harmonic_midi.read(filename, frame_seconds=.25)
+        expected = np.zeros((11, harmonic_midi.RANGE), dtype=np.float32)
+        expected[0:6, 60 - harmonic_midi.MIN_PITCH] = 1
+        expected[6:10, 64 - harmonic_midi.MIN_PITCH] = 1
+        np.testing.assert_array_equal(pitches, expected)
+
+    def test_synthesize_wavetable(self):
+        pitchgram = np.zeros((3, harmonic_midi.RANGE))
+        pitchgram[1, 69 - harmonic_midi.MIN_PITCH] = 1
+        a = harmonic_midi.synthesize_audio(pitchgram, tempo=120, synthesizer='wavetable')
+        self.assertEquals(a.sample_rate, 44100)
+        self.assertEquals(a.signal.shape, (3 * 22050, 1))
+        self.assertEquals(np.abs(a.signal[:22050]).max(), 0)
+        self.assertLess(np.abs(a.signal[-22050 + 1000:]).max(), 1e-6)
+        note = a.signal[22050 + 1000:44100, 0]
+        spectrum = np.abs(np.fft.rfft(note))
+        fq = np.argmax(spectrum) * 44100.0 / len(note)
+        self.assertAlmostEquals(fq, 440, delta=2)
+
+    def test_wavetable_cache_bound(self):
+        pitchgram = np.zeros((2, harmonic_midi.RANGE))
+        pitchgram[:, 20:30] = 1
+        cache_bytes = harmonic_midi.WAVETABLE_CACHE_BYTES
+        harmonic_midi.WAVETABLE_CACHE_BYTES = 2**22
+        try:
+            for tempo in [60, 90, 120, 150, 180]:
+                a = harmonic_midi.synthesize_wavetable(pitchgram, tempo=tempo)
+                reference = harmonic_midi.synthesize_wavetable(pitchgram, tempo=tempo)
+                self.assertTrue(np.array_equal(a.signal, reference.signal))
+            self.assertLessEqual(sum(t.nbytes for t in harmonic_midi._wavetables.values()),
+                                 2**22)
+        finally:
+            harmonic_midi.WAVETABLE_CACHE_BYTES = cache_bytes
+
+    def test_synthesize_wavetable_long(self):
+        # 200 seconds of 60 voice audio
+        np.random.seed(0)
+        pitchgram = (np.random.rand(400, harmonic_midi.RANGE) > .3).astype(float)
+        t = time.time()
+        a = harmonic_midi.synthesize_wavetable(pitchgram)
+        self.assertLess(time.time() - t, 20)
+        self.assertEquals(a.signal.shape, (400 * 22050, 1))
+
+    def test_write_pitchgram(self):
+        pitchgram = np.zeros((300, harmonic_midi.RANGE))
+        pitchgram[0:3, 10] = 1
+        pitchgram[2:5, 12] = .8
+        pitchgram[4, 12] = .2
+        pitchgram[250:, 30] = 2
+        filename = os.path.join(self.directory, 'pitchgram.mid')
+        harmonic_midi.write_pitchgram(pitchgram, filename, tempo=100)
+
+        pitches, tempos = harmonic_midi.read(filename)
+        expected = np.zeros((302, harmonic_midi.RANGE), dtype=np.float32)
+        expected[:300] = pitchgram > .5
+        np.testing.assert_array_equal(pitches, expected)
+        self.assertAlmostEquals(tempos[0][1], 100, 3)
+
+        with open(filename, 'rb') as f:
+            self.assertEquals(harmonic_midi.pitchgram_to_midi_bytes(pitchgram, tempo=100),
+                              f.read())
@@ -1,8 +1,12 @@
 import unittest2 as unittest
 import numpy as np
+from scipy.signal import medfilt2d
+from scipy.cluster.vq import vq
 
 from andreasmusic import audio
 from andreasmusic import spectrum
+from andreasmusic import chroma
+from andreasmusic import pitches
 
 class TestSpectrum(unittest.TestCase):
 
@@ -31,3 +35,219 @@ class TestSpectrum(unittest.TestCase):
         predicted_peaks = np.ones(s.shape[1]) * np.round(2048 * f / (fs / 2.0))
         actual_peaks = np.argmax(s, 0)
         self.assertTrue(np.all(actual_peaks == predicted_peaks))
+
+    def test_spectrogram_matches_framewise_fft(self):
+        np.random.seed(0)
+        signal = np.random.randn(20000, 1).astype(np.float32)
+        a = audio.Audio(signal, 44100)
+        s = spectrum.get_spectrogram(a, 1024, 300)
+        c = spectrum.get_spectrogram(a, 1024, 300, return_angles=True)
+        window = np.hanning(1024)
+        self.assertEquals(s.shape, (64, 512))
+        self.assertEquals(c.shape, (64, 1024))
+        for i in xrange(len(s)):
+            expected = np.fft.fft(signal[i * 300:i * 300 + 1024, 0] * window)
+            self.assertTrue(np.allclose(c[i], expected))
+            self.assertTrue(np.allclose(s[i], np.abs(expected[:512])))
+
+    def test_spectrogram_float32(self):
+        np.random.seed(0)
+        a = audio.Audio(np.random.randn(10000, 1), 44100)
+        s64 = spectrum.get_spectrogram(a, 512, 256)
+        s32 = spectrum.get_spectrogram(a, 512, 256, dtype=np.float32)
+        c32 = spectrum.get_spectrogram(a, 512, 256, return_angles=True, dtype=np.float32)
+        self.assertEquals(s32.dtype, np.float32)
+        self.assertEquals(c32.dtype, np.complex64)
+        self.assertTrue(np.allclose(s32, s64, rtol=1e-4, atol=1e-4))
+
+    def test_iter_spectrogram_matches_batch(self):
+        np.random.seed(0)
+        a = audio.Audio(np.random.randn(10000, 1).astype(np.float32), 44100)
+        for hop_size in [256, 300.5]:
+            s = spectrum.get_spectrogram(a, 1024, hop_size)
+            blocks = list(spectrum.iter_spectrogram(a, 1024, hop_size, block_frames=7))
+            self.assertTrue(all(len(b) <= 7 for b in blocks))
+            self.assertTrue(np.array_equal(np.vstack(blocks), s))
+
+    def test_iter_spectrogram_stereo(self):
+        np.random.seed(0)
+        signal = np.random.randn(10000, 2).astype(np.float32)
+        a = audio.Audio(signal, 44100)
+        for hop_size in [256, 300.5]:
+            s = spectrum.get_spectrogram(a, 1024, hop_size)
+            blocks = list(spectrum.iter_spectrogram(a, 1024, hop_size, block_frames=7))
+            self.assertTrue(all(b.shape[0] == 2 and b.shape[1] <= 7 for b in blocks))
+            self.assertTrue(np.array_equal(np.concatenate(blocks, 1), s))
+
+        # signal blocks like audio.read_blocks yields, with a downmix
+        blocks = [signal[t:t + 999] for t in xrange(0, len(signal), 999)]
+        streamed = spectrum.iter_spectrogram(iter(blocks), 512, 128, block_frames=5,
+                                             downmix='mid_side')
+        s = spectrum.get_spectrogram(a, 512, 128, downmix='mid_side')
+        self.assertTrue(np.allclose(np.concatenate(list(streamed), 1), s))
+
+    def test_iter_spectrogram_from_signal_blocks(self):
+        np.random.seed(0)
+        signal = np.random.randn(10000, 1)
+        a = audio.Audio(signal, 44100)
+        c = spectrum.get_spectrogram(a, 512, 128, return_angles=True)
+        blocks = [signal[t:t + 999] for t in xrange(0, len(signal), 999)]
+        streamed = spectrum.iter_spectrogram(iter(blocks), 512, 128, block_frames=5,
+                                             return_angles=True)
+        self.assertTrue(np.array_equal(np.vstack(list(streamed)), c))
+
+    def test_spectrogram_to_overtones(self):
+        np.random.seed(0)
+        sr = 22050
+        window_size = 2048
+        halfwin = window_size / 2.0
+        s = np.random.rand(10, window_size / 2)
+        overtones = spectrum.spectrogram_to_overtones(s, sr, window_size, harmonics=8)
+        self.assertEquals(overtones.shape, (10, spectrum.MAX_PITCH - spectrum.MIN_PITCH, 8))
+
+        pitch_x = 20
+        freq = pitches.C0.fq * 2 ** ((pitch_x + spectrum.MIN_PITCH) / 12.0)
+        index = np.round(halfwin * freq / (sr / 2))
+        filterbank = np.array([
+            np.exp(-(np.linspace(-x, 1 - x, halfwin) / (x / 24.0)) ** 2)
+            for x in np.arange(index, index * 9, index) / halfwin])
+        filterbank = (filterbank.T / np.sum(filterbank, 1)).T
+        self.assertTrue(np.allclose(overtones[:, pitch_x, :], s.dot(filterbank.T)))
+
+        resynth = spectrum.overtones_to_spectrogram(overtones, sr, window_size)
+        self.assertEquals(resynth.shape, s.shape)
+
+    def test_get_audio_round_trip(self):
+        np.random.seed(0)
+        signal = np.random.randn(20000, 1)
+        a = audio.Audio(signal, 44100)
+        for half_spectrum in [False, True]:
+            for hop_size in [256, 1000]:
+                s = spectrum.get_spectrogram(a, 1024, hop_size, return_angles=True,
+                                             half_spectrum=half_spectrum)
+                self.assertEquals(s.shape[1], 513 if half_spectrum else 1024)
+                resynth = spectrum.get_audio(s, 44100, 1024, hop_size)
+                self.assertEquals(resynth.signal.shape, ((len(s) - 1) * hop_size + 1024, 1))
+                # the first and last samples are silenced by the window
+                self.assertTrue(np.allclose(resynth.signal[2:-2], signal[2:len(resynth.signal) - 2],
+                                            atol=1e-4))
+
+    def test_hpss(self):
+        np.random.seed(0)
+        a = audio.Audio(np.random.randn(30000, 1), 8000)
+        s = spectrum.get_spectrogram(a, 800, 400, return_angles=True, half_spectrum=True)
+
+        harmonic, percussive = spectrum.hpss(s, 11, half_spectrum=True)
+        self.assertTrue(np.allclose(harmonic + percussive, s))
+
+        magnitude = np.abs(s)
+        h = medfilt2d(magnitude, (11, 1)) ** 2
+        p = medfilt2d(magnitude, (1, 11)) ** 2
+        self.assertTrue(np.allclose(harmonic, s * h / (h + p)))
+
+        blocked = spectrum.median_filter(s, -11, half_spectrum=True, block_frames=7)
+        self.assertTrue(np.array_equal(blocked, percussive))
+
+    def test_median_filter_audio(self):
+        np.random.seed(0)
+        a = audio.Audio(np.random.randn(30000, 1), 8000)
+        filtered = spectrum.median_filter(a)
+        self.assertEquals(filtered.signal.shape, (30000, 1))
+        self.assertEquals(filtered.sample_rate, 8000)
+
+    def test_filter_overtones_static(self):
+        np.random.seed(0)
+        sg = np.random.rand(5, 512)
+
+        expected = np.copy(sg)
+        mx = np.max(sg)
+        for i in xrange(127, 0, -1):
+            fb = spectrum.get_filterbank(i, 512)
+            for t, s in enumerate(expected):
+                expected[t] *= 1 - (1 - fb) * min(s[i] * 5 / mx, 1)
+
+        progress = []
+        filtered = spectrum.filter_overtones_static(sg, progress=progress.append)
+        self.assertTrue(np.allclose(filtered, expected))
+        self.assertEquals(progress, [100])
+
+    def test_centroid_mask(self):
+        np.random.seed(0)
+        overtones = np.random.rand(40, 48, 16) ** 4
+        centroids = spectrum.fit_overtone_centroids(overtones, max_samples=100, seed=1)
+        self.assertTrue(np.array_equal(
+            centroids, spectrum.fit_overtone_centroids(overtones, max_samples=100, seed=1)))
+
+        other = np.random.rand(10, 30, 16)
+        other[2] = 0
+        filtered = spectrum._get_centroid_mask(other, centroids)
+        self.assertEquals(filtered.shape, other.shape)
+        self.assertTrue(np.all(filtered[2] == 0))
+        self.assertTrue(np.array_equal(filtered[:, :, 0], other[:, :, 0]))
+
+        flat = other.reshape((-1, 16))
+        row = flat[5]
+        codes, _ = vq(row[np.newaxis] / np.max(row), centroids)
+        expected = np.maximum(row[1:] - centroids[codes[0], 1:] * np.max(row), 0)
+        self.assertTrue(np.allclose(filtered.reshape((-1, 16))[5, 1:], expected))
+
+    def test_stereo_spectrogram(self):
+        np.random.seed(0)
+        signal = np.random.randn(10000, 2).astype(np.float32)
+        a = audio.Audio(signal, 44100)
+        s = spectrum.get_spectrogram(a, 1024, 256)
+        self.assertEquals(s.shape, (2, 36, 512))
+        for channel_x in range(2):
+            mono = spectrum.get_spectrogram(a.get_channel(channel_x), 1024, 256)
+            self.assertTrue(np.array_equal(s[channel_x], mono))
+
+        c = spectrum.get_spectrogram(a, 1024, 300.5, return_angles=True)
+        self.assertTrue(np.allclose(
+            c[1], spectrum.get_spectrogram(a.get_channel(1), 1024, 300.5, return_angles=True)))
+
+        mean = spectrum.get_spectrogram(a, 1024, 256, downmix='mean')
+        mono = audio.Audio(np.mean(signal, 1)[:, np.newaxis], 44100)
+        self.assertTrue(np.allclose(mean, spectrum.get_spectrogram(mono, 1024, 256)))
+
+        mid_side = spectrum.get_spectrogram(a, 1024, 256, downmix='mid_side')
+        side = audio.Audio((signal[:, :1] - signal[:, 1:]) / 2, 44100)
+        self.assertEquals(mid_side.shape, (2, 36, 512))
+        self.assertTrue(np.allclose(mid_side[1], spectrum.get_spectrogram(side, 1024, 256)))
+
+    def test_padded_variable_spectra(self):
+        np.random.seed(0)
+        signal = np.random.randn(8000, 2)
+        a = audio.Audio(signal, 8000)
+        split_points = [0, 1000, 3000, 3001, 7999]
+        spectra, lengths, fft_sizes = spectrum.get_variable_spectra(a, split_points, padded=True)
+        self.assertEquals(lengths.tolist(), [1000, 2000, 1, 4998, 1])
+        self.assertEquals(fft_sizes.tolist(), [1024, 2048, 1, 8192, 1])
+        self.assertEquals(spectra.shape, (2, 5, 4097))
+        self.assertTrue(np.allclose(spectra[1, 1, :1025], np.fft.rfft(signal[1000:3000, 1], 2048)))
+        self.assertTrue(np.all(spectra[1, 1, 1025:] == 0))
+        self.assertTrue(np.allclose(spectra[0, 4, 0], signal[7999, 0]))
+
+        mono = audio.Audio(signal[:, :1], 8000)
+        magnitudes = spectrum.get_variable_spectra(mono, split_points, n_bins=512)
+        self.assertEquals(magnitudes.shape, (5, 512))
+        # every other bin of the 2048 point fft of the second segment
+        self.assertTrue(np.allclose(magnitudes[1], np.abs(np.fft.rfft(signal[1000:3000, 0], 2048))[:1024:2]))
+        chromagram = chroma.get_chromagram(magnitudes, 8000)
+        self.assertEquals(chromagram.shape, (5, 12))
+
+        stereo = spectrum.get_variable_spectra(a, split_points, n_bins=512)
+        self.assertEquals(stereo.shape, (2, 5, 512))
+        self.assertTrue(np.allclose(stereo[0], magnitudes))
+
+    def test_stereo_variable_spectra_and_median_filter(self):
+        np.random.seed(0)
+        signal = np.random.randn(8000, 2)
+        a = audio.Audio(signal, 8000)
+        spectra = spectrum.get_variable_spectra(a, [0, 1000, 3000])
+        self.assertEquals([x.shape for x in spectra], [(2, 1000), (2, 2000), (2, 5000)])
+        self.assertTrue(np.allclose(spectra[1][0], np.fft.fft(signal[1000:3000, 0])))
+
+        filtered = spectrum.median_filter(a)
+        self.assertEquals(filtered.signal.shape, (8000, 2))
+        left = spectrum.median_filter(a.get_channel(0))
+        self.assertTrue(np.allclose(filtered.signal[:, :1], left.signal))
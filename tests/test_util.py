@@ -0,0 +1,191 @@
+import os
+import shutil
+import tempfile
+import functools
+import unittest2 as unittest
+import numpy as np
+
+from andreasmusic import util
+
+def square(x):
+    return x * x
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError('three')
+    return x
+
+class TestBatch(unittest.TestCase):
+
+    def test_ordered(self):
+        results = list(util.parallel_batch(square, range(20), n_workers=2,
+                                           chunksize=3, max_in_flight=4,
+                                           ordered=True))
+        self.assertEquals([r.input for r in results], range(20))
+        self.assertEquals([r.value for r in results], [x * x for x in range(20)])
+
+    def test_unordered_errors(self):
+        results = list(util.parallel_batch(fail_on_three, range(10), n_workers=3))
+        self.assertEquals(sorted(r.input for r in results), range(10))
+        failed = [r for r in results if r.error is not None]
+        self.assertEquals(len(failed), 1)
+        self.assertEquals(failed[0].input, 3)
+        self.assertIn('ValueError: three', failed[0].error)
+
+    def test_stop_early(self):
+        results = util.parallel_batch(square, xrange(100000), n_workers=2,
+                                      max_in_flight=4)
+        self.assertEquals(next(results).error, None)
+        results.close()
+
+    def test_pipeline_sink(self):
+        directory = tempfile.mkdtemp()
+        try:
+            sink = util.NpySink(directory)
+            pipeline = util.Pipeline(int, np.arange, functools.partial(np.multiply, 2))
+            failures = util.run_batch(pipeline, ['3', '5', 'x'], sink, n_workers=2)
+            self.assertEquals([f.input for f in failures], ['x'])
+            self.assertTrue(np.array_equal(np.load(sink.path('5')), np.arange(5) * 2))
+            self.assertFalse(os.path.exists(sink.path('x')))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_npy_sink_names(self):
+        directory = tempfile.mkdtemp()
+        try:
+            sink = util.NpySink(directory)
+            self.assertNotEquals(sink.path('a/01.mp3'), sink.path('b/01.mp3'))
+
+            sink = util.NpySink(directory, root='/music')
+            self.assertEquals(sink.path('/music/a/01.mp3'),
+                              os.path.join(directory, 'a', '01.npy'))
+            outside = sink.path('/other/01.mp3')
+            self.assertEquals(os.path.dirname(outside), directory)
+            self.assertNotEquals(outside, sink.path('/music/01.mp3'))
+            sink('/music/a/01.mp3', np.arange(3))
+            sink('/music/b/01.mp3', np.arange(4))
+            self.assertTrue(np.array_equal(np.load(sink.path('/music/a/01.mp3')), np.arange(3)))
+            self.assertTrue(np.array_equal(np.load(sink.path('/music/b/01.mp3')), np.arange(4)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lazy_parallel(self):
+        self.assertEquals(list(util.lazy_parallel(square, range(5), 2)),
+                          [0, 1, 4, 9, 16])
+
+calls = []
+
+def feature(filename, scale=1):
+    calls.append(filename)
+    with open(filename) as f:
+        return np.arange(len(f.read())) * scale
+
+class Scaled(object):
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def run(self, filename):
+        return feature(filename, self.scale)
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        del calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def test_hit_and_miss(self):
+        cache = util.FeatureCache(os.path.join(self.directory, 'cache'))
+        cached_feature = cache.cached(feature)
+        a = self.write('a.txt', 'abc')
+        b = self.write('b.txt', 'abc')
+
+        self.assertTrue(np.array_equal(cached_feature(a), np.arange(3)))
+        value = cached_feature(b)
+        self.assertIsInstance(value, np.memmap)
+        self.assertTrue(np.array_equal(value, np.arange(3)))
+        self.assertEquals(calls, [a])
+
+        self.assertTrue(np.array_equal(cached_feature(a, scale=2), np.arange(3) * 2))
+        self.assertEquals(calls, [a, a])
+
+    def test_identities(self):
+        cache = util.FeatureCache(os.path.join(self.directory, 'cache'))
+        a = self.write('a.txt', 'abc')
+
+        self.assertTrue(np.array_equal(cache(Scaled(2).run, a), np.arange(3) * 2))
+        self.assertTrue(np.array_equal(cache(Scaled(5).run, a), np.arange(3) * 5))
+        self.assertEquals(cache.path(Scaled(2).run, a, (), {}),
+                          cache.path(Scaled(2).run, a, (), {}))
+
+        pipeline = util.Pipeline(Scaled(3).run, np.sqrt)
+        self.assertTrue(np.array_equal(cache(pipeline, a), np.sqrt(np.arange(3) * 3)))
+        self.assertEquals(cache.path(pipeline, a, (), {}),
+                          cache.path(util.Pipeline(Scaled(3).run, np.sqrt), a, (), {}))
+        self.assertNotEquals(cache.path(pipeline, a, (), {}),
+                             cache.path(util.Pipeline(Scaled(3).run, np.exp), a, (), {}))
+
+        with self.assertRaises(TypeError):
+            cache(lambda f: np.ones(3), a)
+        ones = cache.cached(lambda f: np.ones(3), key='ones')
+        zeros = cache.cached(lambda f: np.zeros(3), key='zeros')
+        self.assertTrue(np.array_equal(ones(a), np.ones(3)))
+        self.assertTrue(np.array_equal(zeros(a), np.zeros(3)))
+
+    def test_lru_eviction(self):
+        cache = util.FeatureCache(os.path.join(self.directory, 'cache'))
+        filenames = [self.write('%d.txt' % i, 'x' * (100 + i)) for i in range(3)]
+        for filename in filenames:
+            cache(feature, filename)
+        entries = cache.entries()
+        self.assertEquals(len(entries), 3)
+
+        # make the first entry the most recently used
+        paths = [cache.path(feature, f, (), {}) + '.npy' for f in filenames]
+        for i, path in enumerate([paths[1], paths[2], paths[0]]):
+            os.utime(path, (1000 + i, 1000 + i))
+
+        cache.max_bytes = sum(size for _, size, _ in entries) - 1
+        cache.evict()
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertTrue(os.path.exists(paths[0]))
+
+    def test_eviction_walks_rarely(self):
+        cache = util.FeatureCache(os.path.join(self.directory, 'cache'))
+        walks = []
+        entries = cache.entries
+        def counting_entries():
+            walks.append(True)
+            return entries()
+        cache.entries = counting_entries
+
+        filenames = [self.write('%d.txt' % i, '%03d' % i + 'x' * 97) for i in range(40)]
+        cache(feature, filenames[0])
+        entry_size = os.path.getsize(cache.path(feature, filenames[0], (), {}) + '.npy')
+        cache.max_bytes = 20 * entry_size
+
+        for filename in filenames[1:]:
+            cache(feature, filename)
+        # one walk for the initial estimate, one when it first passes
+        # max_bytes, then one every third write as 90% is 18 entries
+        self.assertEquals(len(walks), 8)
+        total = sum(size for _, size, _ in entries())
+        self.assertLessEqual(total, cache.max_bytes)
+
+    def test_atomic_write_failure(self):
+        filename = os.path.join(self.directory, 'out')
+        with self.assertRaises(ValueError):
+            with util.atomic_write(filename) as f:
+                f.write('partial')
+                raise ValueError()
+        self.assertEquals(os.listdir(self.directory), [])